@@ -1,15 +1,24 @@
 import argparse
+import atexit
 import base64
+import contextlib
+import copy
+import hashlib
+import importlib.util
 import json
 import os
+import random
 import re
 import signal
 import subprocess
 import sys
+import threading
 import traceback
-import requests,send2trash
-from bs4 import BeautifulSoup
+# requests, bs4, send2trash, asyncio and http.server are imported by the functions using them so that starting
+# the script(e.g. for a bare m3u8 link) doesn't pay for importing them
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import unquote, urljoin, urlparse
 import time
 import logging
 
@@ -20,6 +29,52 @@ import logging
 # TODO Allow user to specify directory name for batch download by utilizing % string formatting e.g. print("%(name)s said hi" % {"name": "Sam", "age": "21"})
 
 user_agent = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36"
+# File caching the paths of the webdrivers installed by webdriver_manager
+driver_cache_file = os.path.join(os.path.expanduser("~"), ".twitdl_drivers.json")
+# ffmpeg libopus settings of the transcode profiles selectable with --profile and --channel-profiles
+# default keeps libopus' own settings, voice profiles downmix to mono for speech heavy streams and
+# compression_level trades encoding speed for quality at the same bitrate(10 is slowest and best)
+transcode_profiles = {
+    "default": [],
+    "voice-24k": ['-ac', '1', '-ar', '24000', '-b:a', '24k', '-application', 'voip'],
+    "voice": ['-ac', '1', '-ar', '48000', '-b:a', '32k', '-application', 'voip'],
+    "voice-fast": ['-ac', '1', '-ar', '48000', '-b:a', '32k', '-application', 'voip', '-compression_level', '0'],
+    "stereo-64k": ['-ac', '2', '-ar', '48000', '-b:a', '64k', '-application', 'audio'],
+    "music": ['-ac', '2', '-ar', '48000', '-b:a', '96k', '-application', 'audio'],
+    "music-128k": ['-ac', '2', '-ar', '48000', '-b:a', '128k', '-application', 'audio'],
+}
+# Set on a keyboard interrupt so the running downloads stop after their current segment
+stop_event = threading.Event()
+# Browsers shared by all the passcode protected videos, sized with --drivers
+driver_pool = None
+# Converts the downloaded mp4 files into .opus while the downloads are running, set up in main()
+transcoder = None
+# Passcodes that unlocked videos in previous runs and the number of passcodes tried at once(--passcode-workers)
+passcode_cache = None
+passcode_workers = 1
+# Connection pool shared by every session so the connections are kept alive between requests, its settings and the
+# (connect, read) timeout of every request, all set up with configureHttp()
+http_adapter = None
+http_settings = {"pool_size": 10, "retries": 3, "backoff": 0.5}
+http_timeout = (10, 30)
+# Folder of the pages cached between runs, seconds a cached page of every kind is used without asking the server
+# and the cache itself, set up in main() unless --no-cache is given
+http_cache_dir = os.path.join(os.path.expanduser("~"), ".twitdl_cache")
+cache_ttls = {
+    "listing": 600,
+    "movie": 6 * 3600,
+}
+http_cache = None
+# Timings of the stages of the run, set up in main() with --metrics-log, --prometheus or --timings
+telemetry = None
+# Token bucket shared by every page request, set up in main() with --rate
+page_limiter = None
+# Jobs that failed for good, written to --failures at the end of the run, set up in main()
+failure_log = None
+# Parser used by beautifulsoup, lxml is a lot faster than the builtin html.parser when it's installed
+html_parser = "lxml" if importlib.util.find_spec("lxml") is not None else "html.parser"
+# Modules that must not be imported when the script starts, checked by --benchmark-startup
+deferred_imports = ["requests", "urllib3", "bs4", "lxml", "send2trash", "asyncio", "selenium", "webdriver_manager"]
 # Adds a link, name, and output argument
 # Returns the arguments
 def arguments():
@@ -67,10 +122,299 @@ def arguments():
                         nargs='+',
                         help="Cookie file path in netscape format")
 
+    parser.add_argument('-w', '--workers',
+                        type=int,
+                        default=1,
+                        help="Number of videos to download concurrently in batch mode (default: 1)")
+
+    parser.add_argument('--host-limit',
+                        type=int,
+                        default=2,
+                        help="Maximum number of concurrent downloads from the same dlXXXX.twitcasting.tv "
+                             "edge host (default: 2)")
+
+    parser.add_argument('--extract',
+                        type=str,
+                        metavar='MANIFEST',
+                        help="Only extract the videos' info and m3u8 urls of the channel(or the single video) and append "
+                             "them as jobs to this json lines manifest file(don't download)")
+
+    parser.add_argument('--manifest',
+                        type=str,
+                        help="Download the jobs of a manifest file created by --extract instead of scraping a link. "
+                             "Jobs already in the --archive file are skipped so the download can be resumed")
+
+    parser.add_argument('--shard',
+                        type=str,
+                        help="Only download the part of the --manifest jobs belonging to this shard e.g. 1/4 "
+                             "(jobs are split by video id)")
+
+    parser.add_argument('--crawl-workers',
+                        type=int,
+                        default=1,
+                        help="Number of channel pages to fetch concurrently (default: 1)")
+
+    parser.add_argument('--rate',
+                        type=float,
+                        default=5,
+                        help="Maximum number of pages requested per second across all threads, lowered automatically "
+                             "while the site answers 429/5xx and raised back afterwards, 0 for no limit (default: 5)")
+
+    parser.add_argument('--scrape-workers',
+                        type=int,
+                        default=1,
+                        help="Number of movie pages to resolve into m3u8 urls concurrently (default: 1)")
+
+    parser.add_argument('--sync',
+                        type=int,
+                        nargs='?',
+                        const=3,
+                        metavar='RUN',
+                        help="Incrementally sync the channel by going through the newest pages first and stopping once "
+                             "RUN videos in a row are already in the --archive file (default RUN: 3)")
+
+    parser.add_argument('--drivers',
+                        type=int,
+                        default=1,
+                        help="Maximum number of browsers kept open to unlock passcode protected videos (default: 1)")
+
+    parser.add_argument('--passcode-workers',
+                        type=int,
+                        default=1,
+                        help="Number of passcodes from --file to try at once on a locked video (default: 1)")
+
+    parser.add_argument('--passcode-cache',
+                        type=str,
+                        default=os.path.join(os.path.expanduser("~"), ".twitdl_passcodes.json"),
+                        help="Json file remembering which passcode unlocked which video and channel so they're tried "
+                             "first (default: ~/.twitdl_passcodes.json)")
+
+    parser.add_argument('--native-hls',
+                        action='store_true',
+                        help="Download the HLS segments concurrently instead of through ffmpeg, ffmpeg then only "
+                             "remuxes them into the mp4")
+
+    parser.add_argument('--segment-workers',
+                        type=int,
+                        default=4,
+                        help="Number of HLS segments fetched concurrently per video with --native-hls (default: 4)")
+
+    parser.add_argument('--transcode-workers',
+                        type=int,
+                        default=os.cpu_count() or 1,
+                        help="Number of mp4 files converted into .opus at once while downloading (default: cpu count)")
+
+    parser.add_argument('--audio-only',
+                        action='store_true',
+                        help="Encode the stream straight into .opus while downloading instead of downloading the mp4 "
+                             "and converting it afterwards")
+
+    parser.add_argument('--profile',
+                        type=str,
+                        default="default",
+                        choices=list(transcode_profiles),
+                        help="Transcode profile used to encode the .opus files (default: default)")
+
+    parser.add_argument('--channel-profiles',
+                        type=str,
+                        help="Json file mapping channel names(as in the channel url) to the transcode profile of "
+                             "their videos e.g. {\"natsuiromatsuri\": \"voice\"}")
+
+    parser.add_argument('--transcode-threads',
+                        type=int,
+                        help="Number of threads each opus encode uses")
+
+    parser.add_argument('--benchmark-profiles',
+                        type=str,
+                        metavar='SAMPLE',
+                        help="Encode the sample file with every transcode profile, print their speed and size and exit")
+
+    parser.add_argument('--watch',
+                        type=str,
+                        metavar='FILE',
+                        help="Text file with one channel name or link per line, keeps watching them and records "
+                             "each one as soon as it goes live")
+
+    parser.add_argument('--poll-interval',
+                        type=float,
+                        default=15,
+                        help="Seconds between the live checks of a channel with --watch (default: 15)")
+
+    parser.add_argument('--max-poll-interval',
+                        type=float,
+                        default=60,
+                        help="Seconds the live checks of an idle channel slow down to with --watch (default: 60)")
+
+    parser.add_argument('--watch-concurrency',
+                        type=int,
+                        default=16,
+                        help="Maximum number of live checks in flight with --watch (default: 16)")
+
+    parser.add_argument('--serve',
+                        type=str,
+                        metavar='[HOST:]PORT',
+                        help="Run as a daemon accepting channel, movie and m3u8 jobs through a local http api "
+                             "(POST /jobs, GET /jobs/<id>)")
+
+    parser.add_argument('--daemon-workers',
+                        type=int,
+                        default=2,
+                        help="Number of jobs the daemon runs at once (default: 2)")
+
+    parser.add_argument('--pool-size',
+                        type=int,
+                        default=10,
+                        help="Number of kept alive connections per host shared by every request, should be at least "
+                             "the number of segment, scrape and passcode workers (default: 10)")
+
+    parser.add_argument('--http-retries',
+                        type=int,
+                        default=3,
+                        help="Number of retries of a request failing to connect or read (default: 3)")
+
+    parser.add_argument('--http-backoff',
+                        type=float,
+                        default=0.5,
+                        help="Backoff factor in seconds between the retries of a failed request (default: 0.5)")
+
+    parser.add_argument('--connect-timeout',
+                        type=float,
+                        default=10,
+                        help="Seconds to wait for a connection to the server (default: 10)")
+
+    parser.add_argument('--read-timeout',
+                        type=float,
+                        default=30,
+                        help="Seconds to wait for the server to send data (default: 30)")
+
+    parser.add_argument('--parser',
+                        choices=['lxml', 'html.parser'],
+                        help="The html parser used for the pages (default: lxml if it's installed else html.parser)")
+
+    parser.add_argument('--benchmark-parsers',
+                        type=str,
+                        metavar='DIRECTORY',
+                        help="Time every html parser with and without only parsing the needed tags over the saved "
+                             ".html pages of a directory and exit")
+
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        help="Always fetch the listing and movie pages instead of using the ones cached by earlier runs")
+
+    parser.add_argument('--cache-size',
+                        type=int,
+                        default=200,
+                        help="Maximum size in MiB of the page cache, the least recently used pages are removed first "
+                             "(default: 200)")
+
+    parser.add_argument('--stall-timeout',
+                        type=int,
+                        default=60,
+                        help="Seconds an ffmpeg download may go without making progress before it's killed and "
+                             "retried, 0 to never kill it (default: 60)")
+
+    parser.add_argument('--stall-retries',
+                        type=int,
+                        default=2,
+                        help="Number of times a stalled download is restarted before it fails (default: 2)")
+
+    parser.add_argument('--progress-interval',
+                        type=int,
+                        default=10,
+                        help="Seconds between the progress lines printed for every ffmpeg download (default: 10)")
+
+    parser.add_argument('--job-retries',
+                        type=int,
+                        default=3,
+                        help="Number of times a failed video is retried at the end of the run with an exponential "
+                             "backoff before it's written to the failures file (default: 3)")
+
+    parser.add_argument('--retry-delay',
+                        type=float,
+                        default=30,
+                        help="Seconds to wait before the first retry of the failed videos, doubled for every "
+                             "following retry (default: 30)")
+
+    parser.add_argument('--failures',
+                        type=str,
+                        default="failures.jsonl",
+                        metavar='FILE',
+                        help="File the videos that still failed after their retries are written to along with why, "
+                             "it can be fed back with --manifest (default: failures.jsonl in the output directory)")
+
+    parser.add_argument('--metrics-log',
+                        type=str,
+                        metavar='FILE',
+                        help="Append a json line with the duration, bytes and throughput of every stage(page fetch, "
+                             "parse, m3u8 resolve, unlock, download, transcode) and video to FILE")
+
+    parser.add_argument('--prometheus',
+                        type=str,
+                        metavar='FILE',
+                        help="Keep FILE updated with the stage totals in the prometheus text format "
+                             "(--serve also exposes them on GET /metrics)")
+
+    parser.add_argument('--timings',
+                        action='store_true',
+                        help="Print a table of how long every stage took at the end of the run")
+
+    parser.add_argument('--benchmark-startup',
+                        type=float,
+                        nargs='?',
+                        const=0,
+                        metavar='MAX_MS',
+                        help="Time importing the script with -X importtime, print the slowest imports and exit with an "
+                             "error if a module that should be imported later is imported at startup or if it takes "
+                             "longer than MAX_MS")
+
+    parser.add_argument('--http-stats',
+                        action='store_true',
+                        help="Print the number of requests and how many of them reused a kept alive connection on exit")
+
+    parser.add_argument('--check-http',
+                        action='store_true',
+                        help="Check against a local server that 429 and 503 responses with a Retry-After header are "
+                             "retried by the script rather than failing the request, then exit")
+
     args = parser.parse_args()
     return args
 
 
+# Function takes in the browser name, its webdriver_manager class and whether to skip the cached path
+# Returns the path of the driver binary, only asking webdriver_manager for it when the cached path is missing
+# along with whether the path came from the cache
+def driverPath(browser, driverManager, refresh=False):
+    try:
+        with open(driver_cache_file, 'r', encoding='utf-8') as cache_file:
+            driver_cache = json.load(cache_file)
+    except (OSError, ValueError):
+        driver_cache = {}
+    path = driver_cache.get(browser)
+    if not refresh and path is not None and os.path.isfile(path):
+        return path, True
+    path = driverManager().install()
+    driver_cache[browser] = path
+    try:
+        with open(driver_cache_file, 'w', encoding='utf-8') as cache_file:
+            json.dump(driver_cache, cache_file)
+    except OSError:
+        pass
+    return path, False
+
+
+# Function takes in the browser name, its webdriver_manager class and a function starting the browser from a driver path
+# Returns the started driver, installing the driver again when the cached one can't start e.g. after a browser update
+def startDriver(browser, driverManager, start):
+    path, cached = driverPath(browser, driverManager)
+    try:
+        return start(path)
+    except Exception as driverException:
+        if not cached:
+            raise
+        print(f"{driverException}\nReinstalling the {browser} driver")
+    return start(driverPath(browser, driverManager, refresh=True)[0])
+
+
 def webDriverSetup():
     try:
         from selenium import webdriver
@@ -96,7 +440,8 @@ def webDriverSetup():
                     f"--user-agent={user_agent}")
                 chrome_options.add_argument("--origin=https://twitcasting.tv")
                 chrome_options.add_experimental_option('excludeSwitches', ['enable-logging'])
-                driver = webdriver.Chrome(service=Service(ChromeDriverManager().install()), options=chrome_options)
+                driver = startDriver("chrome", ChromeDriverManager,
+                                     lambda path: webdriver.Chrome(service=Service(path), options=chrome_options))
                 break
             except Exception as webdriverException:
                 print(webdriverException)
@@ -114,7 +459,8 @@ def webDriverSetup():
                 firefox_options.set_preference("general.useragent.override",
                                        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36")
                 firefox_options.add_argument("--origin=https://twitcasting.tv")
-                driver = webdriver.Firefox(service=Service(GeckoDriverManager().install()), options=firefox_options)
+                driver = startDriver("firefox", GeckoDriverManager,
+                                     lambda path: webdriver.Firefox(service=Service(path), options=firefox_options))
                 print('Using Firefox Driver')
                 break
             except Exception as webdriverException:
@@ -127,7 +473,8 @@ def webDriverSetup():
                 opts.add_argument(
                     "user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:89.0) Gecko/20100101 Firefox/89.0")
                 opts.add_argument("Origin: https://twitcasting.tv")
-                driver = webdriver.Edge(service=Service(EdgeChromiumDriverManager().install()), options=opts)
+                driver = startDriver("edge", EdgeChromiumDriverManager,
+                                     lambda path: webdriver.Edge(service=Service(path), options=opts))
                 print('Using Edge Driver')
                 break
             except Exception as webdriverException:
@@ -140,7 +487,8 @@ def webDriverSetup():
                 opts.add_argument(
                     "user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/89.0.4389.114 Safari/537.36")
                 opts.add_argument("Origin: https://twitcasting.tv")
-                driver = webdriver.Opera(service=Service(OperaDriverManager().install()), options=opts)
+                driver = startDriver("opera", OperaDriverManager,
+                                     lambda path: webdriver.Opera(service=Service(path), options=opts))
                 print('Using Safari Driver')
                 break
             except Exception as webdriverException:
@@ -151,8 +499,542 @@ def webDriverSetup():
     return driver, WebDriverWait, EC, By
 
 
+# A pool of long-lived browsers used to unlock passcode protected videos
+# Browsers are only started when needed(up to size of them), reused across videos and quit at exit
+class DriverPool:
+    def __init__(self, size):
+        self.size = max(1, size)
+        self.idle = []
+        self.drivers = []
+        # Number of browsers being started outside of the lock
+        self.starting = 0
+        self.helpers = None
+        # Signalled whenever a driver is released or a broken one is dropped so a waiting thread can take its place
+        self.condition = threading.Condition()
+        atexit.register(self.close)
+
+    # Returns a driver along with WebDriverWait, EC and By just like webDriverSetup
+    def acquire(self):
+        with self.condition:
+            while len(self.idle) == 0 and len(self.drivers) + self.starting >= self.size:
+                self.condition.wait()
+            if len(self.idle) != 0:
+                return (self.idle.pop(),) + self.helpers
+            self.starting += 1
+        driver = None
+        try:
+            driver, WebDriverWait, EC, By = webDriverSetup()
+        finally:
+            with self.condition:
+                self.starting -= 1
+                if driver is None:
+                    # Let another waiting thread try to start the browser
+                    self.condition.notify()
+                else:
+                    self.helpers = (WebDriverWait, EC, By)
+                    self.drivers.append(driver)
+        return (driver,) + self.helpers
+
+    # Clears the cookies and the page of the driver so the next video starts from a clean state
+    def release(self, driver):
+        try:
+            driver.delete_all_cookies()
+            driver.get("about:blank")
+        except Exception:
+            # The browser is broken so a waiting thread starts a new one in its place
+            with self.condition:
+                self.drivers.remove(driver)
+                self.condition.notify()
+            try:
+                driver.quit()
+            except Exception:
+                pass
+            return
+        with self.condition:
+            self.idle.append(driver)
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            for driver in self.drivers:
+                try:
+                    driver.quit()
+                except Exception:
+                    pass
+            self.drivers = []
+            self.idle = []
+
+
+# Returns the shared driver pool, creating a single browser pool if main() didn't set one up
+def getDriverPool():
+    global driver_pool
+    if driver_pool is None:
+        driver_pool = DriverPool(1)
+    return driver_pool
+
+
+# Function takes in the pool size, the retries of a failed connection or read, their backoff and the timeouts
+# Sets up the connection pool shared by every session, which is only created with the first session
+def configureHttp(pool_size=10, retries=3, backoff=0.5, connect_timeout=10, read_timeout=30):
+    global http_adapter, http_timeout
+    http_adapter = None
+    http_settings.update(pool_size=pool_size, retries=retries, backoff=backoff)
+    http_timeout = (connect_timeout, read_timeout)
+
+
+# Returns a new session using the shared connection pool
+# Every session keeps its own cookies so passcode unlocks don't leak between videos
+def newSession():
+    global http_adapter
+    import requests
+    if http_adapter is None:
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        retries = http_settings["retries"]
+        # 429 and 5xx responses are retried by soupSetup and fetchHls themselves, even with a Retry-After header
+        # urllib3 would otherwise take them over and raise RetryError with its empty status budget
+        retry = Retry(total=retries, connect=retries, read=retries, status=0, backoff_factor=http_settings["backoff"],
+                      respect_retry_after_header=False, raise_on_status=False)
+        http_adapter = HTTPAdapter(pool_connections=max(http_settings["pool_size"], 10),
+                                   pool_maxsize=max(1, http_settings["pool_size"]), max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", http_adapter)
+    session.mount("http://", http_adapter)
+    return session
+
+
+# Returns the number of requests made through the shared connection pool and the number of connections opened for them
+def httpStats():
+    requests_made, connections = 0, 0
+    if http_adapter is not None:
+        pools = http_adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                requests_made += pool.num_requests
+                connections += pool.num_connections
+    return requests_made, connections
+
+
+# Serves a 429 and then a 503 with a Retry-After header from a local server before the page
+# Exits with an error unless soupSetup gets the page after retrying both of them itself
+def checkHttp():
+    import http.server
+    statuses = [429, 503, 200]
+    served = []
+
+    class RetryAfterHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            status = statuses[min(len(served), len(statuses) - 1)]
+            served.append(status)
+            body = b"<html><body><p>ok</p></body></html>"
+            self.send_response(status)
+            if status != 200:
+                self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RetryAfterHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/"
+    try:
+        soup = soupSetup(url, {}, newSession(), cache=False)
+    except Exception as checkException:
+        sys.exit(f"{checkException}\nA response with Retry-After wasn't handed back to soupSetup")
+    finally:
+        server.shutdown()
+        server.server_close()
+    if served != statuses or soup.find("p") is None:
+        sys.exit(f"Expected the responses {statuses} but got {served}")
+    print(f"Retried {', '.join(str(status) for status in statuses[:-1])} with Retry-After and got the page")
+
+
+# Prints how many of the requests reused a kept alive connection and how many pages came from the cache
+def printHttpStats():
+    requests_made, connections = httpStats()
+    reused = max(0, requests_made - connections)
+    percent = 100 * reused / requests_made if requests_made else 0
+    print(f"HTTP requests: {requests_made}, connections opened: {connections}, reused: {reused}({percent:.0f}%)")
+    if http_cache is not None:
+        print(f"Page cache: {http_cache.hits} hits, {http_cache.revalidated} revalidated, {http_cache.misses} fetched")
+
+
+# Keeps the count, duration and bytes of every stage of the run(fetching pages, parsing, resolving m3u8 urls,
+# unlocking, downloading and transcoding) along with counters such as retries and cache hits
+# Every stage is appended as a json line to log_path and the totals are written in the prometheus text format
+# to prometheus_path(at most every 10 seconds) and printed as a table by close()
+class Telemetry:
+    def __init__(self, log_path=None, prometheus_path=None):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+        self.log_file = open(log_path, 'a', encoding='utf-8') if log_path else None
+        self.prometheus_path = prometheus_path
+        self.exported = 0
+
+    def record(self, stage, seconds, ok=True, **fields):
+        size = fields.get("bytes") or 0
+        with self.lock:
+            totals = self.stages.setdefault(stage, {"runs": 0, "errors": 0, "seconds": 0, "max": 0, "bytes": 0})
+            totals["runs"] += 1
+            totals["errors"] += 0 if ok else 1
+            totals["seconds"] += seconds
+            totals["max"] = max(totals["max"], seconds)
+            totals["bytes"] += size
+        line = {"stage": stage, "seconds": round(seconds, 4), "ok": ok}
+        line.update(fields)
+        if size and seconds > 0:
+            line["mbps"] = round(size * 8 / seconds / 1000000, 2)
+        self.log(line)
+        self.export()
+
+    # Appends a json line to the log e.g. the progress of a download
+    def log(self, line):
+        if self.log_file is None:
+            return
+        with self.lock:
+            self.log_file.write(json.dumps(dict(time=round(time.time(), 3), **line), ensure_ascii=False) + "\n")
+            self.log_file.flush()
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    # Returns the totals in the prometheus text format
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            for metric, key, description in [("twitdl_stage_runs_total", "runs", "Number of times the stage ran"),
+                                             ("twitdl_stage_errors_total", "errors", "Number of times the stage failed"),
+                                             ("twitdl_stage_seconds_total", "seconds", "Seconds spent in the stage"),
+                                             ("twitdl_stage_bytes_total", "bytes", "Bytes handled by the stage")]:
+                lines += [f"# HELP {metric} {description}", f"# TYPE {metric} counter"]
+                for stage, totals in sorted(self.stages.items()):
+                    lines.append(f'{metric}{{stage="{stage}"}} {totals[key]:g}')
+            for name, value in sorted(self.counters.items()):
+                lines += [f"# TYPE twitdl_{name}_total counter", f"twitdl_{name}_total {value:g}"]
+        return "\n".join(lines) + "\n"
+
+    # Rewrites the prometheus file, replacing it at once so a scraper never reads half of it
+    def export(self, force=False):
+        if self.prometheus_path is None:
+            return
+        with self.lock:
+            if not force and time.time() - self.exported < 10:
+                return
+            self.exported = time.time()
+        part_path = self.prometheus_path + ".part"
+        try:
+            with open(part_path, 'w', encoding='utf-8') as prometheus_file:
+                prometheus_file.write(self.prometheus())
+            os.replace(part_path, self.prometheus_path)
+        except OSError as exportException:
+            print(f"{exportException}\nError writing the prometheus file")
+
+    def summary(self):
+        if len(self.stages) == 0:
+            return
+        print(f"\n{'Stage':<16}{'Runs':>6}{'Errors':>8}{'Total s':>10}{'Mean s':>9}{'Max s':>9}{'MiB':>10}{'Mbps':>8}")
+        for stage, totals in sorted(self.stages.items(), key=lambda item: -item[1]["seconds"]):
+            mbps = totals["bytes"] * 8 / totals["seconds"] / 1000000 if totals["bytes"] and totals["seconds"] else 0
+            print(f"{stage:<16}{totals['runs']:>6}{totals['errors']:>8}{totals['seconds']:>10.1f}"
+                  f"{totals['seconds'] / totals['runs']:>9.2f}{totals['max']:>9.2f}{totals['bytes'] / 1048576:>10.1f}"
+                  f"{mbps:>8.1f}")
+        if len(self.counters) > 0:
+            print(", ".join(f"{name}: {value:g}" for name, value in sorted(self.counters.items())))
+
+    def close(self):
+        self.export(force=True)
+        self.summary()
+        if self.log_file is not None:
+            self.log_file.close()
+
+
+# Function takes in the arguments and sets up the telemetry if any of its outputs was asked for
+def setupTelemetry(args, always=False):
+    global telemetry
+    if args.metrics_log or args.prometheus or args.timings or always:
+        telemetry = Telemetry(args.metrics_log, args.prometheus)
+
+
+# Function takes in a stage, its duration and whether it succeeded and records it if there is telemetry
+def recordStage(stage, seconds, ok=True, **fields):
+    if telemetry is not None:
+        telemetry.record(stage, seconds, ok, **fields)
+
+
+# Function takes in the name of a counter(e.g. page_retries) and adds to it if there is telemetry
+def countMetric(name, amount=1):
+    if telemetry is not None and amount:
+        telemetry.count(name, amount)
+
+
+# Times the block as a stage, values put in the yielded dict(e.g. bytes) are recorded along with it
+# A block left by an exception is recorded as failed
+@contextlib.contextmanager
+def timed(stage, **fields):
+    start = time.perf_counter()
+    ok = False
+    try:
+        yield fields
+        ok = True
+    finally:
+        recordStage(stage, time.perf_counter() - start, ok, **fields)
+
+
+# Function takes in the maximum size of the page cache in MiB and sets it up
+def setupCache(cache_size):
+    global http_cache
+    try:
+        http_cache = HttpCache(http_cache_dir, cache_size * 1048576)
+    except OSError as cacheError:
+        print(f"{cacheError}\nCould not set up the page cache, pages won't be cached")
+
+
+# Function takes in a url
+# Returns the kind of page it is for the cache or None if it shouldn't be cached
+def pageKind(url):
+    path = urlparse(url).path
+    if "/movie/" in path:
+        return "movie"
+    if re.search(r'/(show|showclips)(/|$)', path):
+        return "listing"
+    return None
+
+
+# Pages kept on disk between runs, one json file per url(and cookies for member pages) holding the html along with
+# the ETag and Last-Modified it came with so stale pages can be revalidated instead of downloaded again
+# The files' modification time is their last use, the least recently used ones are removed when over max_size
+class HttpCache:
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.hits, self.revalidated, self.misses = 0, 0, 0
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.name.endswith(".json"))
+
+    # Pages fetched with cookies are cached separately since member's only pages differ
+    def key(self, url, cookies):
+        identity = url
+        if cookies:
+            identity += "\n" + json.dumps(sorted(cookies.items()))
+        return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    # Returns the cached entry or None
+    def get(self, key):
+        try:
+            with open(self.path(key), 'r', encoding='utf-8') as cache_file:
+                entry = json.load(cache_file)
+            os.utime(self.path(key))
+        except (OSError, ValueError):
+            return None
+        return entry
+
+    def fresh(self, entry, kind):
+        return time.time() - entry.get("fetched", 0) < cache_ttls.get(kind, 0)
+
+    def put(self, key, entry):
+        data = json.dumps(entry, ensure_ascii=False).encode('utf-8')
+        part_path = f"{self.path(key)}.{os.getpid()}.{threading.get_ident()}.part"
+        try:
+            old_size = os.path.getsize(self.path(key))
+        except OSError:
+            old_size = 0
+        try:
+            with open(part_path, 'wb') as cache_file:
+                cache_file.write(data)
+            os.replace(part_path, self.path(key))
+        except OSError:
+            return
+        with self.lock:
+            self.size += len(data) - old_size
+            if self.size > self.max_size:
+                self.evict()
+
+    # Removes the least recently used pages until the cache is three quarters of its maximum size
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        self.size = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if self.size <= self.max_size * 3 // 4:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+
+    def count(self, outcome):
+        with self.lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+        countMetric(f"cache_{outcome}")
+
+
+# Only lets the parser build the tags with one of the classes, ids or names along with everything inside them
+# so that the listing and movie pages aren't turned into a full tree when only a few tags are read
+class PageStrainer:
+    def __init__(self, classes=(), ids=(), names=()):
+        self.classes = set(classes)
+        self.ids = set(ids)
+        self.names = set(names)
+        self.strainer = None
+
+    def keep(self, name, attrs):
+        if name in self.names or attrs.get("id") in self.ids:
+            return True
+        classes = attrs.get("class") or []
+        if isinstance(classes, str):
+            classes = classes.split()
+        return not self.classes.isdisjoint(classes)
+
+    # Returns the beautifulsoup strainer, created on the first page parsed so bs4 isn't imported before
+    def soupStrainer(self):
+        if self.strainer is None:
+            from bs4 import SoupStrainer
+            keep = self.keep
+
+            class Strainer(SoupStrainer):
+                # Called by beautifulsoup before 4.13
+                def search_tag(self, markup_name=None, markup_attrs={}):
+                    if isinstance(markup_name, str) and keep(markup_name, dict(markup_attrs)):
+                        return markup_name
+                    return None
+
+                # Called by beautifulsoup 4.13 and later
+                def allow_tag_creation(self, nsprefix, name, attrs):
+                    return keep(name, dict(attrs or {}))
+
+                def allow_string_creation(self, string):
+                    return False
+
+            self.strainer = Strainer()
+        return self.strainer
+
+
+# The tags read from a page of the videos of a channel(pageLinks, linkExtract and linkScrape)
+listing_strainer = PageStrainer(classes=["tw-movie-thumbnail", "tw-movie-thumbnail-title", "tw-movie-thumbnail-date",
+                                         "tw-pager", "tw-user-nav-name", "tw-user-nav-list-count", "btn"])
+# The tags read from a movie page(parsePlaylist)
+movie_strainer = PageStrainer(classes=["video-js"], ids=["groupinfolink"])
+# The tags read from the passcode form of a private movie(httpUnlock)
+unlock_strainer = PageStrainer(names=["form"])
+
+
+# Function takes in the maximum milliseconds importing the script may take(0 for no limit) and the number of runs
+# Imports the script in new interpreters with -X importtime and prints the time of the fastest run and its slowest imports
+# Exits with an error when a deferred module is imported at startup or the import is over the limit
+def benchmarkStartup(max_ms=0, runs=5):
+    module_dir, module_file = os.path.split(os.path.abspath(__file__))
+    module = os.path.splitext(module_file)[0]
+    code = (f"import sys; sys.path.insert(0, {module_dir!r}); before = set(sys.modules); import {module}; "
+            f"print(' '.join(name for name in {module}.deferred_imports if name in sys.modules and name not in before))")
+    best, best_imports, imported = None, [], set()
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True)
+        if result.returncode != 0:
+            sys.exit(result.stderr + "\nError importing " + module)
+        imported.update(result.stdout.split())
+        # Lines are "import time: self | cumulative | name" with the name indented by two spaces per level
+        # and come after the modules they imported
+        imports = []
+        for line in result.stderr.splitlines():
+            match = re.match(r'import time:\s+\d+ \|\s+(\d+) \| ( *)(\S+)', line)
+            if match is None:
+                continue
+            if len(match.group(2)) == 0 and match.group(3) != module:
+                imports = []
+            elif len(match.group(2)) == 2:
+                imports.append((int(match.group(1)) / 1000, match.group(3)))
+            elif match.group(3) == module:
+                total = int(match.group(1)) / 1000
+                if best is None or total < best:
+                    best, best_imports = total, imports
+    print(f"Importing {module}: {best:.1f} ms (fastest of {runs} runs)\n")
+    print(f"{'Import':<28}{'ms':>8}")
+    for import_time, name in sorted(best_imports, reverse=True)[:10]:
+        print(f"{name:<28}{import_time:>8.1f}")
+    if imported:
+        sys.exit(f"\nImported at startup: {', '.join(sorted(imported))}")
+    if max_ms and best > max_ms:
+        sys.exit(f"\nStartup took longer than {max_ms:g} ms")
+
+
+# Function takes in the html of a page, the strainer of the only tags needed from it and the parser to use
+# Returns the soup
+def parseHtml(html, strainer=None, parser=None):
+    from bs4 import BeautifulSoup
+    with timed("parse", bytes=len(html)):
+        return BeautifulSoup(html, parser or html_parser,
+                             parse_only=strainer.soupStrainer() if strainer is not None else None)
+
+
+# Function takes in the soup of a page
+# Returns what's read from it: the video links, the playlist of the video and whether it's a member's only video
+def pageSummary(soup):
+    video_tag = soup.find(class_="video-js")
+    return (pageLinks(soup), video_tag.get("data-movie-playlist") if video_tag is not None else None,
+            soup.find(id="groupinfolink") is not None)
+
+
+# Function takes in a directory of saved listing and movie pages
+# Prints how long every parser takes to parse them with and without only parsing the needed tags
+# and whether the same videos were found as with a full html.parser tree
+def benchmarkParsers(directory, rounds=5):
+    pages = []
+    for path in sorted(Path(directory).glob("*.html")):
+        html = path.read_text(encoding="utf-8", errors="replace")
+        if "data-movie-playlist" in html:
+            strainer = movie_strainer
+        elif 'name="password"' in html:
+            strainer = unlock_strainer
+        else:
+            strainer = listing_strainer
+        pages.append((html, strainer))
+    if not pages:
+        sys.exit("No .html pages found in " + directory)
+    expected = [pageSummary(parseHtml(html, parser="html.parser")) for html, strainer in pages]
+    print(f"Pages: {len(pages)} ({sum(len(html) for html, strainer in pages) / 1048576:.1f} MiB), rounds: {rounds}\n")
+    print(f"{'Parser':<14}{'Tags':<8}{'ms/page':>10}{'Speedup':>10}  Same videos")
+    baseline = None
+    for parser in ["html.parser", "lxml"]:
+        for strained in [False, True]:
+            try:
+                start = time.perf_counter()
+                for _ in range(rounds):
+                    soups = [parseHtml(html, strainer if strained else None, parser) for html, strainer in pages]
+                elapsed = (time.perf_counter() - start) / rounds / len(pages)
+            except Exception as parserError:
+                print(f"{parser:<14}{'needed' if strained else 'all':<8}{'failed':>10}  {parserError}")
+                continue
+            baseline = baseline or elapsed
+            # Passcode forms have no videos to compare
+            same = all(pageSummary(soup) == summary
+                       for soup, summary, (html, strainer) in zip(soups, expected, pages) if strainer is not unlock_strainer)
+            print(f"{parser:<14}{'needed' if strained else 'all':<8}{elapsed * 1000:>10.2f}{baseline / elapsed:>9.1f}x"
+                  f"  {'yes' if same else 'no'}")
+
+
 # Set up the soup and return it while requiring a link as an argument
-def soupSetup(cleanLink, cookies, session):
+# Retries with an exponential backoff when rate limited(429) or when the server errors out(5xx)
+# If form data is given then it's posted to the link instead
+# If a strainer is given then only its tags are parsed
+# Listing and movie pages are taken from the page cache while they're fresh and revalidated once they're stale
+def soupSetup(cleanLink, cookies, session, retries=3, data=None, strainer=None, cache=True):
     try:
         url = cleanLink
     except Exception:
@@ -160,8 +1042,54 @@ def soupSetup(cleanLink, cookies, session):
     headers = {
         'User-Agent': f'{user_agent}',
         'Origin': 'https://twitcasting.tv'}
-    req = session.get(url, headers=headers, cookies=cookies)
-    bSoup = BeautifulSoup(req.text, "html.parser")
+    kind = pageKind(url) if cache and data is None and http_cache is not None else None
+    entry = None
+    html = None
+    with timed("page", url=url) as stage:
+        if kind is not None:
+            cache_key = http_cache.key(url, cookies)
+            entry = http_cache.get(cache_key)
+            if entry is not None and http_cache.fresh(entry, kind):
+                http_cache.count("hits")
+                stage["cache"] = "hit"
+                html = entry["text"]
+            if entry is not None and entry.get("etag"):
+                headers['If-None-Match'] = entry["etag"]
+            if entry is not None and entry.get("last_modified"):
+                headers['If-Modified-Since'] = entry["last_modified"]
+        if html is None:
+            for attempt in range(retries + 1):
+                if page_limiter is not None:
+                    page_limiter.wait()
+                if data is not None:
+                    req = session.post(url, headers=headers, cookies=cookies, data=data, timeout=http_timeout)
+                else:
+                    req = session.get(url, headers=headers, cookies=cookies, timeout=http_timeout)
+                pageResponse(req.status_code)
+                if (req.status_code != 429 and req.status_code < 500) or attempt == retries:
+                    break
+                retry_after = req.headers.get("Retry-After", "")
+                delay = int(retry_after) if retry_after.isdigit() else 2 ** attempt
+                print(f"Error {req.status_code} requesting {url}, retrying in {delay}s")
+                time.sleep(delay)
+            stage.update(status=req.status_code, retries=attempt, bytes=len(req.content))
+            countMetric("page_retries", attempt)
+            html = req.text
+            if kind is not None:
+                if entry is not None and req.status_code == 304:
+                    http_cache.count("revalidated")
+                    stage["cache"] = "revalidated"
+                    entry["fetched"] = time.time()
+                    http_cache.put(cache_key, entry)
+                    html = entry["text"]
+                else:
+                    http_cache.count("misses")
+                    stage["cache"] = "miss"
+                    if req.status_code == 200:
+                        http_cache.put(cache_key, {"url": url, "etag": req.headers.get("ETag"),
+                                                   "last_modified": req.headers.get("Last-Modified"),
+                                                   "fetched": time.time(), "text": req.text})
+    bSoup = parseHtml(html, strainer)
     return bSoup
 
 
@@ -310,6 +1238,78 @@ def getArchive(archiveArg):
     return archivePath, archiveExist
 
 
+# Locks the opened file so that only one process at a time can write to it
+def lockFile(file):
+    if os.name == 'nt':
+        import msvcrt
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+
+
+def unlockFile(file):
+    if os.name == 'nt':
+        import msvcrt
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+
+# The archive text file holding the links of the downloaded videos
+# The file is read once into a set and afterwards only the lines appended since(e.g. by another process
+# sharing the archive) are read, so checking a link doesn't re-read the whole file
+class Archive:
+    def __init__(self, archivePath):
+        self.path = os.path.abspath(archivePath)
+        self.links = set()
+        self.offset = 0
+        self.lock = threading.Lock()
+        with self.lock:
+            self.refresh()
+
+    # Reads the lines added to the file since it was last read
+    def refresh(self):
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        if size == self.offset:
+            return
+        # The file was replaced or truncated so read it again from the start
+        if size < self.offset:
+            self.links = set()
+            self.offset = 0
+        with open(self.path, 'rb') as txt_file:
+            txt_file.seek(self.offset)
+            data = txt_file.read()
+        # Leave a line that's still being written for the next refresh
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].decode('utf-8', errors='replace').splitlines():
+            if line.strip() != "":
+                self.links.add(line.strip())
+        self.offset += end
+
+    def __contains__(self, link):
+        with self.lock:
+            self.refresh()
+            return link in self.links
+
+    def append(self, link):
+        with self.lock:
+            with open(self.path, 'a', newline='', encoding='utf-8') as txt_file:
+                lockFile(txt_file)
+                try:
+                    txt_file.write(link + "\n")
+                    txt_file.flush()
+                finally:
+                    unlockFile(txt_file)
+            self.refresh()
+
+
 def getCookies(cookie_file):
     cookies = {}
     regex = ".*(tc_id|tc_ss)\s(.*)"
@@ -379,14 +1379,147 @@ def urlCount(soup, filter):
         return [totalPages, totalUrl]
 
 
+# Token bucket letting no more than rate requests start per second across all threads(bursts of up to burst requests)
+# The rate is halved whenever the site pushes back(429/5xx) and raised by a twentieth of max_rate after every
+# successful request so it settles just under what the site tolerates(AIMD)
+class RateLimiter:
+    def __init__(self, rate, burst=None, min_rate=0.2):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate) if rate else 0
+        self.burst = burst or max(1, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if self.max_rate == 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Take the token now, a negative balance is the time the caller has to wait for it
+            self.tokens -= 1
+            wait_time = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+    def backoff(self):
+        if self.max_rate == 0:
+            return
+        with self.lock:
+            if self.rate > self.min_rate:
+                self.rate = max(self.min_rate, self.rate / 2)
+                print(f"Server is pushing back, slowing down to {self.rate:.2f} requests/s")
+            # Drop the saved up burst
+            self.tokens = min(self.tokens, 0)
+        countMetric("page_backoffs")
+
+    def success(self):
+        if self.max_rate == 0:
+            return
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+# Limits how many media downloads run at once, starting at limit and halving it(down to 1) whenever a download fails
+# or a segment request is pushed back(429/5xx), then raising it by one after every successful download(AIMD)
+# Used as a context manager around a download
+class DownloadGovernor:
+    def __init__(self, limit):
+        self.max_limit = max(1, limit)
+        self.limit = self.max_limit
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def __enter__(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        with self.condition:
+            self.active -= 1
+            if exc_type is None:
+                self.limit = min(self.max_limit, self.limit + 1)
+            self.condition.notify_all()
+        if exc_type is not None and not issubclass(exc_type, DownloadInterrupted):
+            self.backoff()
+        return False
+
+    def backoff(self):
+        with self.condition:
+            if self.limit > 1:
+                self.limit = max(1, self.limit // 2)
+                print(f"Downloads are failing, only running {self.limit} at once")
+        countMetric("download_backoffs")
+
+
+# Function takes in the status code of a response from the site and tells the rate limiter how it went
+def pageResponse(status_code):
+    if page_limiter is None:
+        return
+    if status_code == 429 or status_code >= 500:
+        page_limiter.backoff()
+    else:
+        page_limiter.success()
+
+
+# Function that takes in the soup of the first page, the channel link and the total pages
+# Fetches the remaining pages with a pool of workers, soupSetup keeps them under the --rate limit
+# Yields the page number and the soup of every page in page order
+def crawlPages(soup, channelLink, totalPages, cookies, session, workers=1):
+    def fetchPage(pageNumber):
+        return soupSetup(updateLink(channelLink, pageNumber), cookies, session, strainer=listing_strainer)
+
+    yield 0, soup
+    if totalPages <= 1:
+        return
+    # A single worker only fetches a page once it's asked for so that stopping early doesn't fetch the rest
+    if workers <= 1:
+        for pageNumber in range(1, totalPages):
+            yield pageNumber, fetchPage(pageNumber)
+        return
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(fetchPage, pageNumber) for pageNumber in range(1, totalPages)]
+        try:
+            for pageNumber, future in enumerate(futures, start=1):
+                yield pageNumber, future.result()
+        finally:
+            # Stop fetching pages nobody is going to read
+            for future in futures:
+                future.cancel()
+
+
+# Function that takes in the soup of a listing page
+# Returns the links of all the videos on the page from newest to oldest
+def pageLinks(soup):
+    domainName = "https://twitcasting.tv"
+    return [domainName + link["href"] for link in soup.find_all("a", class_="tw-movie-thumbnail")]
+
+
 # Function that gets all the m3u8 url(since the page can contain more than one video)
 # cleans it up and then return it along with membership status
-def m3u8_scrape(link, cookies, session):
-    soup = soupSetup(link, cookies, session)
+def m3u8_scrape(link, cookies, session, cache=True):
+    with timed("resolve", link=link):
+        soup = soupSetup(link, cookies, session, strainer=movie_strainer, cache=cache)
+        print(f"\nFinding m3u8 url in {link}")
+        playlist = parsePlaylist(soup)
+    # A cached page can hold m3u8 urls that have expired since
+    if cache and playlist[0] and any(m3u8Expired(m3u8) for m3u8 in playlist[0]):
+        return m3u8_scrape(link, cookies, session, cache=False)
+    return playlist
+
+
+# Function that takes in the soup of a movie page and gets its m3u8 urls
+# Returns the m3u8 urls(None for a private video) along with membership status
+def parsePlaylist(soup):
     video_list = []
     m3u8_url = []
     membership_status = False
-    print(f"\nFinding m3u8 url in {link}")
     try:
         # Finds the tag that contains the url
         video_tag = soup.find(class_="video-js")["data-movie-playlist"]
@@ -413,11 +1546,152 @@ def m3u8_scrape(link, cookies, session):
     return video_list
 
 
+# Function takes in a passcode from --passcode(a list of words) or --file(a line ending with a newline)
+# Returns the passcode as it's typed into the password field
+def cleanPasscode(passcode):
+    return "".join(passcode).strip()
+
+
+# Passcodes that unlocked videos before, saved in a json file so they're tried first in later runs
+# For every channel the passcodes are kept most recently successful first
+class PasscodeCache:
+    def __init__(self, cachePath):
+        self.path = cachePath
+        self.lock = threading.Lock()
+        try:
+            with open(self.path, 'r', encoding='utf-8') as cache_file:
+                cache = json.load(cache_file)
+        except (OSError, ValueError):
+            cache = {}
+        self.videos = cache.get("videos", {})
+        self.channels = cache.get("channels", {})
+
+    # Function takes in a movie link and the passcode list
+    # Returns the passcodes in the order they should be tried: the one that unlocked this video before,
+    # then the ones that unlocked videos of the same channel and then the rest of the list
+    def order(self, link, passcode_list):
+        channel, vid_id = movieInfo(link)
+        candidates = []
+        with self.lock:
+            if vid_id in self.videos:
+                candidates.append(self.videos[vid_id])
+            candidates += self.channels.get(channel, [])
+        candidates += [cleanPasscode(passcode) for passcode in passcode_list]
+        return list(dict.fromkeys(candidates))
+
+    def record(self, link, passcode):
+        channel, vid_id = movieInfo(link)
+        with self.lock:
+            self.videos[vid_id] = passcode
+            channel_passcodes = [passcode] + [other for other in self.channels.get(channel, []) if other != passcode]
+            self.channels[channel] = channel_passcodes[:20]
+            try:
+                with open(self.path + ".tmp", 'w', encoding='utf-8') as cache_file:
+                    json.dump({"videos": self.videos, "channels": self.channels}, cache_file, ensure_ascii=False)
+                os.replace(self.path + ".tmp", self.path)
+            except OSError as cacheException:
+                print(str(cacheException) + "\nError saving the passcode cache")
+
+
+# Function takes in a movie link e.g. https://twitcasting.tv/natsuiromatsuri/movie/661406762
+# Returns the channel name and the video id
+def movieInfo(link):
+    match = re.search(r'twitcasting\.tv/(.*?)/movie/(\d+)', link)
+    if match is None:
+        return None, str(re.search(r"(\d+)$", link).group())
+    return match.group(1), match.group(2)
+
+
+# Function takes in a movie link and a passcode and submits the passcode form without a browser
+# Returns the m3u8 urls of the unlocked video or None if the passcode didn't unlock it
+def httpUnlock(link, passcode, cookies, session):
+    passcode = cleanPasscode(passcode)
+    # The form holds the id of this session so it's never taken from the cache
+    soup = soupSetup(link, cookies, session, strainer=unlock_strainer, cache=False)
+    password_input = soup.find("input", attrs={"name": "password"})
+    if password_input is None or password_input.find_parent("form") is None:
+        return None
+    form = password_input.find_parent("form")
+    # Send back the hidden fields of the form(e.g. the session id) along with the passcode
+    form_data = {}
+    for form_input in form.find_all("input"):
+        if form_input.get("name") is not None:
+            form_data[form_input["name"]] = form_input.get("value", "")
+    form_data["password"] = passcode
+    action = urljoin(link, form.get("action") or link)
+    print(f"\nTrying passcode on {link}")
+    return parsePlaylist(soupSetup(action, cookies, session, data=form_data, strainer=movie_strainer))[0]
+
+
+# Function takes in a movie link and a passcode and tries it
+# Returns the m3u8 urls of the unlocked video or None
+def tryPasscode(link, passcode, cookies, session):
+    import requests
+    try:
+        with timed("http_unlock", link=link) as stage:
+            m3u8_url = httpUnlock(link, passcode, cookies, session)
+            stage["unlocked"] = m3u8_url is not None and len(m3u8_url) != 0
+    except requests.RequestException:
+        return None
+    if m3u8_url is None or len(m3u8_url) == 0:
+        return None
+    return m3u8_url
+
+
+# Function takes in a movie link and the passcode list and tries the passcodes without a browser
+# With --passcode-workers the passcodes are tried concurrently, each with its own session so the unlocks don't mix
+# Returns the m3u8 urls of the unlocked video along with the passcode that unlocked it
+def passcodeUnlock(link, passcode_list, cookies, session):
+    if passcode_cache is not None:
+        candidates = passcode_cache.order(link, passcode_list)
+    else:
+        candidates = list(dict.fromkeys(cleanPasscode(passcode) for passcode in passcode_list))
+    m3u8_url, current_passcode = None, None
+    if passcode_workers <= 1:
+        for passcode in candidates:
+            m3u8_url = tryPasscode(link, passcode, cookies, session)
+            if m3u8_url is not None:
+                current_passcode = passcode
+                break
+    else:
+        with ThreadPoolExecutor(max_workers=passcode_workers) as executor:
+            futures = {executor.submit(tryPasscode, link, passcode, cookies, newSession()): passcode
+                       for passcode in candidates}
+            for future in as_completed(futures):
+                if future.result() is not None:
+                    m3u8_url, current_passcode = future.result(), futures[future]
+                    # Don't try the passcodes still waiting
+                    for pending in futures:
+                        pending.cancel()
+                    break
+    if current_passcode is not None and passcode_cache is not None:
+        passcode_cache.record(link, current_passcode)
+    return m3u8_url, current_passcode
+
+
+# Function takes in a list of movie links and resolves their m3u8 urls with a pool of workers
+# Yields every link along with its m3u8 urls and membership status as soon as it's resolved
+def resolveMovies(links, cookies, session, workers=1):
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(m3u8_scrape, link, cookies, session): link for link in links}
+        try:
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as resolveException:
+                    recordFailure({"link": futures[future]}, "resolve", resolveException)
+                    continue
+                yield futures[future], result
+        finally:
+            for future in futures:
+                future.cancel()
+
+
 # Function takes three arguments: the file name, soup, and boolean value batch
 # Scrapes the video title and url and then write it into a txt file
 # Returns the number of video url extracted for that page
-def linkScrape(fileName, soup, batch, passcode_list, cookies):
-    session = requests.Session()
+def linkScrape(fileName, soup, batch, passcode_list, cookies, scrape_workers=1):
+    session = newSession()
     video_list = []
     domainName = "https://twitcasting.tv"
     linksExtracted = 0
@@ -442,11 +1716,12 @@ def linkScrape(fileName, soup, batch, passcode_list, cookies):
             # add all video url to video list
             for link in url_list:
                 video_list.append(domainName + link["href"])
-            # loops through the link and title list in parallel
-            for link, title, date in zip(video_list, title_list, date_list):
-                m3u8_link, membership_status = m3u8_scrape(link, cookies, session)
+            # Map the links to their title and date so the movies can be handled in the order they're resolved
+            video_info = {link: (title, date) for link, title, date in zip(video_list, title_list, date_list)}
+            for link, (m3u8_link, membership_status) in resolveMovies(list(video_info), cookies, session, scrape_workers):
+                title, date = video_info[link]
                 # check to see if there are any m3u8 links
-                if len(m3u8_link) != 0:
+                if m3u8_link is not None and len(m3u8_link) != 0:
                     try:
                         date = date.text.strip()
                         video_date = re.search('(\d{4})/(\d{2})/(\d{2})', date)
@@ -454,7 +1729,8 @@ def linkScrape(fileName, soup, batch, passcode_list, cookies):
                         month_date = video_date.group(2)
                         year_date = video_date.group(1)
                     except:
-                        exit("Error getting dates")
+                        print(f"Error getting the date of {link}, skipping it")
+                        continue
                     # Only write title if src isn't in the tag
                     # Meaning it's not a private video title
                     if not title.has_attr('src'):
@@ -464,88 +1740,1005 @@ def linkScrape(fileName, soup, batch, passcode_list, cookies):
                         title = "".join(title)
                         print("Title: " + title)
                     linksExtracted = linksExtracted + 1
-                    txt_file.write(m3u8_link + "\n")
+                    txt_file.write("\n".join(m3u8_link) + "\n")
                 else:
                     print("Error can't find m3u8 links")
     return linksExtracted, video_list
 
 
-# Function takes four arguments: soup, directory path, boolean value batch, and the channel link
-# Scrapes for video info
-# And then calls ffmpeg to download the stream
-# Returns the number of video url extracted for that page
-def linkDownload(soup, directoryPath, batch, channelLink, passcode_list, archive_info, cookies):
-    video_list = []
-    m3u8_link = []
-    domainName = "https://twitcasting.tv"
-    linksExtracted = 0
-    curr_dir = directoryPath
-    archivePath = archive_info[0]
-    archiveExist = archive_info[1]
-    m3u8_url = []
-    txt_format = 'w'
-    session = requests.Session()
-    # Batch download
-    if batch:
-        # Maybe consider separating extractor from downloader
-        # find all video url
-        url_list = soup.find_all("a", class_="tw-movie-thumbnail")
-        # get channel name
-        channel_name = soup.find("span", class_="tw-user-nav-name").text.strip()
-        # find all tag containing video title
-        title_list = soup.find_all("span", class_="tw-movie-thumbnail-title")
-        # find all tag containing date/time
+# Function takes in a m3u8 url, the output file path and the cookies
+# Returns the ffmpeg command used to download the m3u8 into the output file
+# With audio_only the video is dropped and the audio is encoded into opus on the fly with the profile_args
+def ffmpegCommand(m3u8, output_path, cookies, stats=True, overwrite=False, audio_only=False, profile_args=[],
+                  progress=False):
+    # Use -re, -user_agent, and -headers to set x1 read speed and avoid 502 error
+    # Use -n to avoid overwriting files and then avoid re-encoding by using copy
+    # -c copy -bsf:a aac_adtstoasc
+    ffmpeg_list = ['ffmpeg', '-v', 'quiet']
+    if progress:
+        # key=value lines on stdout read by runFfmpeg
+        ffmpeg_list += ['-nostats', '-progress', 'pipe:1']
+    elif stats:
+        ffmpeg_list += ['-stats']
+    ffmpeg_list += ['-user_agent', user_agent, '-headers', "Origin: https://twitcasting.tv"]
+    if cookies != {}:
+        ffmpeg_list += ['-headers', f"Cookie: 'tc_id'={cookies['tc_id']}; tc_ss={cookies['tc_ss']}"]
+    # Note split at & since cmd doesn't like it: e.g. https://dl193236.twitcasting.tv/tc.vod.v2/v1/streams/760007902.0.2/hls/master.m3u8?k=%2Ftc.vod%2Fv%2F760007902.0.2-1677557604-1677586404-f21a6f25-00d91311525594a4&spm=1
+    ffmpeg_list += ['-y' if overwrite else '-n', '-i', m3u8.split("&")[0]]
+    if audio_only:
+        ffmpeg_list += ['-vn', '-c:a', 'libopus'] + profile_args + ['-f', 'opus']
+    else:
+        ffmpeg_list += ['-c', 'copy', '-movflags', '+faststart', '-f', 'mp4', '-bsf:a', 'aac_adtstoasc']
+    ffmpeg_list += [output_path]
+    return ffmpeg_list
+
+
+# Raised when ffmpeg made no progress for the stall timeout and was killed
+class DownloadStalled(subprocess.CalledProcessError):
+    def __init__(self, cmd, timeout):
+        super().__init__(-9, cmd)
+        self.timeout = timeout
+
+    def __str__(self):
+        return f"ffmpeg made no progress for {self.timeout}s and was killed"
+
+
+# Function takes in a number of seconds
+# Returns it as H:MM:SS
+def formatDuration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+# Function takes in the name of a download and its progress
+# Returns the progress line printed for it
+def progressLine(name, progress):
+    line = f"{name}: {formatDuration(progress['out_time'])}"
+    if progress["duration"]:
+        line += f"/{formatDuration(progress['duration'])}"
+    line += f" {progress['total_size'] / 1048576:.1f} MiB"
+    if progress["speed"] is not None:
+        line += f" {progress['speed']:.2f}x"
+    if progress["eta"] is not None:
+        line += f" ETA {formatDuration(progress['eta'])}"
+    return line
+
+
+# Function takes in a ffmpeg command using -progress pipe:1, the name of the download, the duration of the video if known
+# and the dict the progress(out_time, total_size, speed, eta) is kept in
+# Prints the progress every progress_interval seconds and kills ffmpeg once neither its position nor its output size
+# has grown for stall_timeout seconds
+# Raises DownloadStalled when ffmpeg was killed for stalling, DownloadInterrupted when it was killed by a keyboard
+# interrupt or CalledProcessError when it failed
+def runFfmpeg(ffmpeg_list, name, duration=None, progress=None, stall_timeout=60, progress_interval=10):
+    if stop_event.is_set():
+        raise DownloadInterrupted(name)
+    progress = progress if progress is not None else {}
+    progress.update(name=name, out_time=0.0, total_size=0, speed=None, duration=duration, eta=None)
+    lock = threading.Lock()
+    last_progress = [time.monotonic()]
+    process = subprocess.Popen(ffmpeg_list, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, text=True,
+                               errors='replace')
+
+    # ffmpeg writes a block of key=value lines ending with progress=continue(or end) every half second
+    def readProgress():
+        block = {}
+        for line in process.stdout:
+            key, _, value = line.strip().partition("=")
+            block[key] = value
+            if key != "progress":
+                continue
+            try:
+                # out_time_ms is in microseconds as well
+                out_time = int(block.get("out_time_us", block.get("out_time_ms", "0"))) / 1000000
+            except ValueError:
+                out_time = progress["out_time"]
+            total_size = int(block["total_size"]) if block.get("total_size", "").isdigit() else progress["total_size"]
+            try:
+                speed = float(block.get("speed", "").rstrip("x"))
+            except ValueError:
+                speed = None
+            with lock:
+                if out_time > progress["out_time"] or total_size > progress["total_size"]:
+                    last_progress[0] = time.monotonic()
+                progress.update(out_time=out_time, total_size=total_size, speed=speed)
+                if duration and speed:
+                    progress["eta"] = max(0.0, duration - out_time) / speed
+            block = {}
+
+    reader = threading.Thread(target=readProgress, daemon=True)
+    reader.start()
+    next_report = time.monotonic() + progress_interval
+    while True:
         try:
-            date_list = soup.find_all(class_="tw-movie-thumbnail-date")
-        except:
-            # When the class "tw-movie-thumbnail-date", can't be found due to perhaps newly uploaded video or 1st video
-            date_list = soup.find_all("time")
+            returncode = process.wait(timeout=1)
+            break
+        except subprocess.TimeoutExpired:
+            pass
+        # A keyboard interrupt stops the download, the next run starts it over
+        if stop_event.is_set():
+            process.kill()
+            process.wait()
+            reader.join(5)
+            raise DownloadInterrupted(name)
+        now = time.monotonic()
+        with lock:
+            idle = now - last_progress[0]
+            snapshot = dict(progress)
+        if stall_timeout and idle > stall_timeout:
+            process.kill()
+            process.wait()
+            # The reader is a daemon thread so it isn't waited on for long if something still holds the pipe
+            reader.join(5)
+            raise DownloadStalled(ffmpeg_list, stall_timeout)
+        if progress_interval and now >= next_report:
+            next_report = now + progress_interval
+            print(progressLine(name, snapshot))
+            if telemetry is not None:
+                telemetry.log(dict(snapshot, event="progress"))
+    reader.join()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, ffmpeg_list)
+
+
+# Raised when a m3u8 can't be downloaded by the native HLS downloader(e.g. it's encrypted) so ffmpeg is used instead
+class HlsUnsupported(Exception):
+    pass
+
+
+# Raised by a download stopped by a keyboard interrupt, its progress is kept to be resumed
+class DownloadInterrupted(Exception):
+    pass
+
+
+# Function takes in the m3u8 url and the text of the playlist
+# Returns a dict holding the variants of a master playlist or the init segment and segments of a media playlist
+def parseM3u8(url, text):
+    lines = [line.strip() for line in text.splitlines() if line.strip() != ""]
+    if len(lines) == 0 or lines[0] != "#EXTM3U":
+        raise HlsUnsupported(f"{url} isn't a m3u8 playlist")
+    playlist = {"variants": [], "init": None, "segments": [], "duration": 0.0, "encrypted": False}
+    bandwidth = None
+    for line in lines[1:]:
+        if line.startswith("#EXT-X-STREAM-INF"):
+            match = re.search(r'BANDWIDTH=(\d+)', line)
+            bandwidth = int(match.group(1)) if match is not None else 0
+        elif line.startswith("#EXT-X-BYTERANGE") or (line.startswith("#EXT-X-MAP") and "BYTERANGE=" in line):
+            # Segments that are ranges of a single file would be fetched whole, ffmpeg handles them instead
+            raise HlsUnsupported(f"{url} uses byte range segments")
+        elif line.startswith("#EXT-X-MAP"):
+            match = re.search(r'URI="(.*?)"', line)
+            if match is not None:
+                playlist["init"] = urljoin(url, match.group(1))
+        elif line.startswith("#EXT-X-KEY") and "METHOD=NONE" not in line:
+            playlist["encrypted"] = True
+        elif line.startswith("#EXTINF"):
+            match = re.search(r'#EXTINF:([\d.]+)', line)
+            if match is not None:
+                playlist["duration"] += float(match.group(1))
+        elif not line.startswith("#"):
+            # The uri following #EXT-X-STREAM-INF is a variant rather than a segment
+            if bandwidth is not None:
+                playlist["variants"].append((bandwidth, urljoin(url, line)))
+                bandwidth = None
+            else:
+                playlist["segments"].append(urljoin(url, line))
+    return playlist
+
+
+# Function takes in a url, the session and the request headers and gets it while retrying on 429/5xx
+# Returns the response
+def fetchHls(url, session, headers, cookies, retries=3, governor=None):
+    for attempt in range(retries + 1):
+        req = session.get(url, headers=headers, cookies=cookies, timeout=http_timeout)
+        if (req.status_code != 429 and req.status_code < 500) or attempt == retries:
+            break
+        # Fewer downloads at once also means fewer segment requests
+        if governor is not None:
+            governor.backoff()
+        time.sleep(2 ** attempt)
+    countMetric("segment_retries", attempt)
+    req.raise_for_status()
+    countMetric("segment_bytes", len(req.content))
+    return req
+
+
+# Function takes in a m3u8 url and gets its media playlist, picking the highest bandwidth variant of a master playlist
+# Returns the parsed media playlist
+def mediaPlaylist(m3u8, session, headers, cookies):
+    playlist = parseM3u8(m3u8, fetchHls(m3u8, session, headers, cookies).text)
+    if len(playlist["variants"]) > 0:
+        variant = max(playlist["variants"])[1]
+        playlist = parseM3u8(variant, fetchHls(variant, session, headers, cookies).text)
+    if playlist["encrypted"]:
+        raise HlsUnsupported("Encrypted playlist")
+    if len(playlist["segments"]) == 0:
+        raise HlsUnsupported("Playlist without segments")
+    return playlist
+
+
+# Function takes in the path of a download's state file
+# Returns the number of segments, the number of them already written and the bytes written for them
+def readHlsState(statePath):
+    try:
+        with open(statePath, 'r', encoding='utf-8') as state_file:
+            state = json.load(state_file)
+        return state["total"], state["done"], state["bytes"]
+    except (OSError, ValueError, KeyError):
+        return None, 0, 0
 
-        # Creates folder name based on channel name
-        # createFolder(channel_name)
-        # download_dir = curr_dir + "\\" + checkFileName(channel_name)
 
-        download_dir = curr_dir
+# Function takes in the path of a download's state file and saves how far the download got
+def writeHlsState(statePath, total, done, written):
+    with open(statePath + ".tmp", 'w', encoding='utf-8') as state_file:
+        json.dump({"total": total, "done": done, "bytes": written}, state_file)
+    os.replace(statePath + ".tmp", statePath)
 
-        # add all video url to video list
-        for link in url_list:
-            video_list.append(domainName + link["href"])
 
-        # loops through the link and title list in parallel
-        for link, title, date in zip(video_list, title_list, date_list):
+# Function takes in a m3u8 url, the output file path, the cookies and the session
+# Fetches the segments with a pool of workers and writes them in order into a temporary file
+# which ffmpeg then only remuxes(-c copy) into the output file
+# A sidecar state file records the segments written so an interrupted download resumes from the last good segment
+def hlsDownload(m3u8, output_path, cookies, session, workers=4, governor=None):
+    headers = {
+        'User-Agent': f'{user_agent}',
+        'Origin': 'https://twitcasting.tv'}
+    playlist = mediaPlaylist(m3u8, session, headers, cookies)
+    urls = ([playlist["init"]] if playlist["init"] is not None else []) + playlist["segments"]
+    temp_path = output_path + ".hls"
+    state_path = output_path + ".hls.json"
+    total, done, written = readHlsState(state_path)
+    # Only resume the same playlist and drop anything written after the last recorded segment
+    if total != len(urls) or not os.path.isfile(temp_path) or os.path.getsize(temp_path) < written:
+        done, written = 0, 0
+    else:
+        print(f"Resuming from segment {done}/{len(urls)}")
+    with open(temp_path, 'ab' if done > 0 else 'wb') as temp_file:
+        temp_file.truncate(written)
+    print(f"Downloading {len(playlist['segments'])} segments from {m3u8.split('?')[0]}")
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor, open(temp_path, 'ab') as temp_file:
+        # Only keep a window of segments in flight so memory doesn't grow with the length of the video
+        window = max(1, workers) * 2
+        futures = {}
+        try:
+            for index in range(done, len(urls)):
+                for ahead in range(index, min(index + window, len(urls))):
+                    if ahead not in futures:
+                        futures[ahead] = executor.submit(fetchHls, urls[ahead], session, headers, cookies,
+                                                       governor=governor)
+                if stop_event.is_set():
+                    raise DownloadInterrupted(output_path)
+                temp_file.write(futures.pop(index).result().content)
+                temp_file.flush()
+                writeHlsState(state_path, len(urls), index + 1, temp_file.tell())
+        finally:
+            for future in futures.values():
+                future.cancel()
+    # Remux into a partial file and only give it the final name once it's complete
+    part_path = output_path + ".part"
+    ffmpeg_list = ['ffmpeg', '-v', 'quiet', '-y', '-i', temp_path, '-c', 'copy', '-movflags', '+faststart',
+                   '-f', 'mp4', '-bsf:a', 'aac_adtstoasc', part_path]
+    subprocess.run(ffmpeg_list, check=True, stdin=subprocess.DEVNULL)
+    os.replace(part_path, output_path)
+    os.remove(temp_path)
+    os.remove(state_path)
+
+
+# Function takes in the path of a media file
+# Returns its duration in seconds read by ffprobe or None if it can't be read
+def mediaDuration(filename):
+    try:
+        probe = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0',
+                                filename], capture_output=True, text=True, stdin=subprocess.DEVNULL)
+        if probe.returncode != 0:
+            return None
+        return float(probe.stdout.strip())
+    except (OSError, ValueError):
+        return None
+
+
+# Function takes in the path of an audio file and checks that ffprobe can read a duration from it
+def opusValid(filename):
+    if not os.path.isfile(filename):
+        return False
+    duration = mediaDuration(filename)
+    return duration is not None and duration > 0
+
+
+# Function takes in a sample media file and encodes it with every transcode profile
+# Prints the encoding speed(x realtime) and the output size of each profile
+def benchmarkProfiles(sample, threads=None):
+    duration = mediaDuration(sample)
+    if duration is None:
+        sys.exit("Can not read the duration of the sample file")
+    print(f"Sample: {sample} ({duration:.1f}s, {os.path.getsize(sample) / 1048576:.1f} MiB)\n")
+    print(f"{'Profile':<14}{'Speed':>10}{'Size':>12}{'kbps':>8}")
+    output_path = sample + ".benchmark.opus"
+    for profile, profile_args in transcode_profiles.items():
+        if threads is not None:
+            profile_args = profile_args + ['-threads', str(threads)]
+        start = time.perf_counter()
+        try:
+            subprocess.run(['ffmpeg', '-v', 'quiet', '-y', '-i', sample, '-vn', '-c:a', 'libopus'] + profile_args +
+                           ['-f', 'opus', output_path], check=True, stdin=subprocess.DEVNULL)
+        except subprocess.CalledProcessError:
+            print(f"{profile:<14}{'failed':>10}")
+            continue
+        elapsed = time.perf_counter() - start
+        size = os.path.getsize(output_path)
+        print(f"{profile:<14}{duration / elapsed:>9.1f}x{size / 1048576:>8.2f} MiB{size * 8 / duration / 1000:>8.1f}")
+    if os.path.isfile(output_path):
+        os.remove(output_path)
+
+
+# Function takes in the file name of a mp4 and converts it into .opus with the ffmpeg arguments of a transcode profile
+# The mp4 is then sent to the trash can
+# Returns "skipped" if a valid .opus already existed else "transcoded"
+def transcodeOpus(filename, profile_args=[]):
+    originalFilename = filename.split(".mp4")[0]
+    state = "skipped"
+    if not opusValid(f"{originalFilename}.opus"):
+        # Encode into a partial file of this process and thread so a .opus is always complete
+        # even when another run is converting the same file
+        part_path = f"{originalFilename}.opus.{os.getpid()}.{threading.get_ident()}.part"
+        try:
+            subprocess.run(['ffmpeg', '-v', 'quiet', '-y', '-i', filename, '-vn', '-c:a', 'libopus'] + profile_args +
+                           ['-f', 'opus', part_path], check=True, stdin=subprocess.DEVNULL)
+            os.replace(part_path, f"{originalFilename}.opus")
+        except (subprocess.CalledProcessError, OSError):
             try:
-                txt_list = []
-                # If there is an archive file path set to append mode and if not set to write mode
-                if archivePath is not None:
-                    if archiveExist:
-                        txt_format = 'a'
-                        # List index out of range error when theres extra/less space
-                        # Get all the links in the file and append into txt_list array
-                        with open(archivePath, 'r', newline="") as txt_file:
-                            for line in txt_file:
-                                txt_list.append(line.rstrip())
-                        # Check if the link is in the archive txt_list array and if so skip the download
-                        if link in txt_list:
-                            continue
-                    else:
-                        txt_format = 'w'
-            except Exception as archiveException:
-                sys.exit(str(archiveException) + "\n Error occurred creating an archive file")
+                os.remove(part_path)
+            except OSError:
+                pass
+            raise
+        state = "transcoded"
+    # Another run converting the same file may have sent it to the trash can already
+    if os.path.isfile(filename):
+        import send2trash
+        send2trash.send2trash(filename)
+        print(f"{filename} has been sent to the trash can")
+    return state
+
+
+# Transcodes the mp4 files into .opus as soon as they're downloaded so transcoding overlaps with the downloads
+# Only the files handed over by this run are transcoded and the state of each of them is kept in states
+# Every transcode is its own ffmpeg process so the pool is sized to the cpu count by default
+# Files are encoded with the profile of their channel in channel_profiles or else with the run's profile
+class Transcoder:
+    def __init__(self, workers=None, profile="default", channel_profiles={}, threads=None):
+        self.executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+        self.profile = profile
+        self.channel_profiles = channel_profiles
+        self.threads = threads
+        self.futures = {}
+        self.states = {}
+        self.lock = threading.Lock()
+
+    # Returns the libopus arguments used for the channel's files
+    def profileArgs(self, channel=None):
+        profile_args = list(transcode_profiles[self.channel_profiles.get(channel, self.profile)])
+        if self.threads is not None:
+            profile_args += ['-threads', str(self.threads)]
+        return profile_args
+
+    def submit(self, filename, channel=None):
+        with self.lock:
+            if filename in self.states:
+                return
+            self.states[filename] = "queued"
+            self.futures[self.executor.submit(self.transcode, filename, self.profileArgs(channel))] = filename
+
+    def transcode(self, filename, profile_args):
+        try:
+            with timed("transcode", file=os.path.basename(filename), bytes=os.path.getsize(filename)) as stage:
+                self.states[filename] = stage["state"] = transcodeOpus(filename, profile_args)
+        except (subprocess.CalledProcessError, OSError):
+            self.states[filename] = "failed"
+            print(f"Error converting {filename} into .opus")
+
+    # Waits for all the queued transcodes to finish
+    def wait(self):
+        for future in as_completed(list(self.futures)):
+            future.result()
+        self.futures = {}
+        self.executor.shutdown()
+        if len(self.states) > 0:
+            counts = {}
+            for state in self.states.values():
+                counts[state] = counts.get(state, 0) + 1
+            print("\nOpus: " + ", ".join(f"{count} {state}" for state, count in counts.items()))
+
+
+# Keeps the jobs that failed along with the stage they failed at(archive, resolve, date, download) and why
+# A job that's retried successfully is removed again and close() writes the rest as json lines in the manifest
+# format so they can be fed back with --manifest
+# The file is only replaced(or removed once nothing failed) when the run read all of it as its manifest,
+# other runs append their failures which readManifest reads back as the latest record of every video
+class FailureLog:
+    def __init__(self, path, replace=False):
+        self.path = os.path.abspath(path)
+        self.replace = replace
+        self.failures = {}
+        self.lock = threading.Lock()
+
+    def add(self, job, stage, error, attempts=1):
+        failure = {key: job[key] for key in ("id", "link", "title", "date", "member", "m3u8") if key in job}
+        failure.update(stage=stage, error=str(error), attempts=attempts, failed=time.strftime("%Y-%m-%d %H:%M:%S"))
+        with self.lock:
+            self.failures[job["link"]] = failure
+
+    def remove(self, link):
+        with self.lock:
+            self.failures.pop(link, None)
+
+    # Keeps the jobs read back from the failures file until they're downloaded so an interrupted retry doesn't lose them
+    def keep(self, jobs):
+        with self.lock:
+            for job in jobs:
+                self.failures.setdefault(job["link"], dict(job))
+
+    def close(self):
+        if len(self.failures) == 0:
+            if not self.replace:
+                return
+            # Every video of the failures file was retried successfully
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            except OSError as failuresException:
+                print(f"{failuresException}\nError removing the failures file")
+            return
+        try:
+            if self.replace:
+                part_path = f"{self.path}.{os.getpid()}.part"
+                with open(part_path, 'w', newline='', encoding='utf-8') as failures_file:
+                    for failure in self.failures.values():
+                        failures_file.write(json.dumps(failure, ensure_ascii=False) + "\n")
+                os.replace(part_path, self.path)
+            else:
+                writeManifest(self.path, self.failures.values())
+        except OSError as failuresException:
+            print(f"{failuresException}\nError writing the failures file")
+            return
+        print(f"\n{len(self.failures)} videos failed, retry them with --manifest {self.path}")
+
+
+# Function takes in the arguments and the manifest read by the run if any, called once the run is about to download
+# in the output directory
+# Sets up the failure log, which replaces the failures file only if the run is retrying all of it
+def setupFailures(args, manifestPath=None):
+    global failure_log
+    replace = manifestPath is not None and manifestPath == os.path.abspath(args.failures) and args.shard is None
+    failure_log = FailureLog(args.failures, replace)
+
+
+# Function takes in a job(or at least its link), the stage it failed at, the error and the number of attempts
+# Records it in the failure log
+def recordFailure(job, stage, error, attempts=1):
+    if "id" not in job:
+        job = dict(job, id=movieInfo(job["link"])[1])
+    # The ffmpeg command holds the cookies so only its exit status is kept
+    if isinstance(error, subprocess.CalledProcessError) and not isinstance(error, DownloadStalled):
+        error = f"ffmpeg exited with status {error.returncode}"
+    print(f"Failed {job['link']} at {stage}: {error}")
+    countMetric(f"failed_{stage}")
+    if failure_log is not None:
+        failure_log.add(job, stage, error, attempts)
+
+
+# Function takes in a movie link
+# Returns its job read from the movie page, used for the jobs of the failures file that failed before all their info
+# was known
+def movieJob(link, cookies, session):
+    soup = soupSetup(link, cookies, session, cache=False)
+    title_tag = soup.find("span", class_="tw-player-page__title-editor-value")
+    date_tag = soup.find("time")
+    video_date = re.search(r'(\d{4})/(\d{2})/(\d{2})', date_tag.text) if date_tag is not None else None
+    if video_date is None:
+        raise ValueError("Can't find the date of the video")
+    m3u8_link, membership_status = parsePlaylist(soup)
+    if m3u8_link is None or len(m3u8_link) == 0:
+        raise ValueError("Can't find m3u8 links")
+    return {"id": movieInfo(link)[1], "link": link,
+            "title": checkFileName(title_tag.text.strip()) if title_tag is not None else "temp",
+            "date": "".join(video_date.groups()), "member": membership_status, "m3u8": m3u8_link}
+
+
+# Downloads the jobs found by linkDownload using a bounded pool of ffmpeg workers
+# A job is a dict holding the video link and its m3u8 urls along with their output paths
+# Every edge host(e.g. dl193236.twitcasting.tv) only gets host_limit downloads at a time
+# Jobs are reported in the order they were queued and only appended to the archive once all their m3u8 are downloaded
+# With native_hls the segments are fetched by hlsDownload rather than ffmpeg
+# Every downloaded file is handed to the transcoder if there is one
+# With audio_only the m3u8 is encoded straight into .opus by a single ffmpeg without writing the mp4
+# A job that fails doesn't stop the others, it's queued and retried by retryFailed with an exponential backoff
+# jobScheduler gives a caller its own retry queue while sharing the workers, hosts and progress of the scheduler
+class DownloadScheduler:
+    def __init__(self, workers, host_limit, cookies, native_hls=False, segment_workers=4, transcoder=None,
+                 audio_only=False, stall_timeout=60, stall_retries=2, progress_interval=10, job_retries=3,
+                 retry_delay=30):
+        self.workers = max(1, workers)
+        self.host_limit = max(1, host_limit)
+        self.cookies = cookies
+        self.native_hls = native_hls
+        self.segment_workers = segment_workers
+        self.transcoder = transcoder
+        self.audio_only = audio_only
+        self.stall_timeout = stall_timeout
+        self.stall_retries = max(0, stall_retries)
+        self.progress_interval = progress_interval
+        self.job_retries = max(0, job_retries)
+        self.retry_delay = retry_delay
+        # Jobs that failed and are waiting to be retried, once retryFailed is done the jobs that still failed
+        self.retry_queue = []
+        self.retry_lock = threading.Lock()
+        # Number of jobs retried by retryFailed
+        self.retried = 0
+        self.session = newSession()
+        self.governor = DownloadGovernor(self.workers)
+        self.host_semaphores = {}
+        self.host_lock = threading.Lock()
+        # Progress of the ffmpeg downloads running, by output path
+        self.progress = {}
+        self.progress_lock = threading.Lock()
+
+    # Returns the semaphore limiting the downloads from the m3u8's host
+    def hostSemaphore(self, m3u8):
+        host = urlparse(m3u8).hostname
+        with self.host_lock:
+            if host not in self.host_semaphores:
+                self.host_semaphores[host] = threading.BoundedSemaphore(self.host_limit)
+            return self.host_semaphores[host]
+
+    # Downloads a m3u8 into the output file
+    # The file only gets its final name once it's complete so an existing file is a finished download
+    def download(self, m3u8, output_path, channel=None):
+        if self.audio_only:
+            output_path = os.path.splitext(output_path)[0] + ".opus"
+        if os.path.isfile(output_path):
+            # Only the files downloaded by this run are transcoded so it isn't handed to the transcoder
+            print(f"{output_path} has already been downloaded")
+            return
+        if stop_event.is_set():
+            raise DownloadInterrupted(output_path)
+        with self.hostSemaphore(m3u8), self.governor, timed("download", file=os.path.basename(output_path)) as stage:
+            # The interrupt may have come while waiting for a free slot
+            if stop_event.is_set():
+                raise DownloadInterrupted(output_path)
+            downloaded = False
+            # The native downloader writes the whole stream to disk which is what audio_only avoids
+            if self.native_hls and not self.audio_only:
+                try:
+                    hlsDownload(m3u8, output_path, self.cookies, self.session, self.segment_workers, self.governor)
+                    downloaded = True
+                except HlsUnsupported as hlsException:
+                    print(f"{hlsException}, downloading with ffmpeg instead")
+            if not downloaded:
+                # ffmpeg can't resume so a partial file left by an interrupted or stalled download is overwritten
+                part_path = output_path + ".part"
+                profile_args = self.transcoder.profileArgs(channel) if self.transcoder is not None else []
+                ffmpeg_list = ffmpegCommand(m3u8, part_path, self.cookies, stats=False, overwrite=True,
+                                            audio_only=self.audio_only, profile_args=profile_args, progress=True)
+                duration = self.streamDuration(m3u8)
+                name = os.path.basename(output_path)
+                # Every key runFfmpeg sets is there from the start so a snapshot never sees the dict grow
+                progress = dict(name=name, out_time=0.0, total_size=0, speed=None, duration=duration, eta=None)
+                with self.progress_lock:
+                    self.progress[output_path] = progress
+                try:
+                    for attempt in range(self.stall_retries + 1):
+                        try:
+                            runFfmpeg(ffmpeg_list, name, duration, progress, self.stall_timeout,
+                                      self.progress_interval)
+                            break
+                        except DownloadStalled as stallException:
+                            countMetric("stalls")
+                            if attempt == self.stall_retries or stop_event.is_set():
+                                raise
+                            print(f"{stallException}, restarting the download of {name}")
+                finally:
+                    with self.progress_lock:
+                        del self.progress[output_path]
+                os.replace(part_path, output_path)
+            stage.update(native=downloaded, bytes=os.path.getsize(output_path))
+        if self.transcoder is not None and not self.audio_only:
+            self.transcoder.submit(output_path, channel)
+
+    # Returns a copy of the progress of the running downloads that can be sent back as json
+    def progressSnapshot(self):
+        with self.progress_lock:
+            return [dict(progress) for progress in self.progress.values()]
+
+    # Returns the duration of the m3u8's video for the ETA of its download or None if it can't be read
+    def streamDuration(self, m3u8):
+        headers = {
+            'User-Agent': f'{user_agent}',
+            'Origin': 'https://twitcasting.tv'}
+        try:
+            return mediaPlaylist(m3u8, self.session, headers, self.cookies)["duration"] or None
+        except Exception:
+            return None
+
+    # Downloads every m3u8 of a job and then archives it
+    def downloadJob(self, job, directoryPath, archive):
+        if stop_event.is_set():
+            raise DownloadInterrupted(job["link"])
+        with timed("video", link=job["link"]):
+            # Jobs fed back from the failures file may have failed before their info was known
+            if not job.get("m3u8") or not job.get("date") or not job.get("title"):
+                job.update(movieJob(job["link"], self.cookies, self.session))
+            # The m3u8 keys of a job read back from a manifest may have expired since it was extracted
+            if any(m3u8Expired(m3u8) for m3u8 in job["m3u8"]):
+                m3u8_link = m3u8_scrape(job["link"], self.cookies, self.session, cache=False)[0]
+                if m3u8_link is not None and len(m3u8_link) != 0:
+                    job["m3u8"] = m3u8_link
+            job["outputs"] = jobOutputs(job, directoryPath)
+            Path(os.path.dirname(job["outputs"][0]) or ".").mkdir(parents=True, exist_ok=True)
+            for m3u8, output_path in zip(job["m3u8"], job["outputs"]):
+                self.download(m3u8, output_path, movieInfo(job["link"])[0])
+        if archive is not None:
+            archive.append(job["link"])
+        return job
+
+    def run(self, jobs, directoryPath, archive):
+        if len(jobs) == 0:
+            return
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self.downloadJob, job, directoryPath, archive) for job in jobs]
+            try:
+                self.collect(jobs, futures, archive)
+            finally:
+                # The jobs that didn't start yet are dropped when the run stops early e.g. on a keyboard interrupt
+                # rather than waited on by the executor
+                for future in futures:
+                    future.cancel()
+
+    # Reports the jobs in the order they were queued as their futures finish
+    def collect(self, jobs, futures, archive):
+        for job, future in zip(jobs, futures):
+            job["attempts"] = job.get("attempts", 0) + 1
+            try:
+                future.result()
+            except Exception as downloadException:
+                # A keyboard interrupt stops the run rather than failing the jobs
+                if stop_event.is_set():
+                    raise
+                # Recorded right away so it's in the failures file even if the run doesn't get to retry it
+                recordFailure(job, "download", downloadException, job["attempts"])
+                with self.retry_lock:
+                    self.retry_queue.append(job)
+                continue
+            if failure_log is not None:
+                failure_log.remove(job["link"])
+            print(f"\nExecuted and downloaded {len(job['outputs'])} m3u8 from {job['link']}")
+            if archive is not None:
+                print(f"Appended {job['link']} to archive file\n")
+
+    # Retries the failed jobs up to job_retries times, waiting retry_delay seconds before the first retry
+    # and twice as long before every following one
+    def retryFailed(self, directoryPath, archive):
+        for attempt in range(self.job_retries):
+            with self.retry_lock:
+                jobs, self.retry_queue = self.retry_queue, []
+            if len(jobs) == 0 or stop_event.is_set():
+                return
+            delay = self.retry_delay * 2 ** attempt
+            print(f"\nRetrying {len(jobs)} failed videos in {delay:g}s ({attempt + 1}/{self.job_retries})")
+            if stop_event.wait(delay):
+                with self.retry_lock:
+                    self.retry_queue.extend(jobs)
+                return
+            with self.retry_lock:
+                self.retried += len(jobs)
+            self.run(jobs, directoryPath, archive)
+
+    # Returns a scheduler sharing everything with this one but its retry queue
+    # so the failures of concurrent callers are retried and counted separately
+    def jobScheduler(self):
+        scheduler = copy.copy(self)
+        scheduler.retry_queue = []
+        scheduler.retry_lock = threading.Lock()
+        scheduler.retried = 0
+        return scheduler
+
+
+# Function takes in a channel name or link e.g. https://twitcasting.tv/natsuiromatsuri/show/
+# Returns the channel name
+def channelName(channel):
+    channel = channel.strip()
+    match = re.search(r'twitcasting\.tv/([^/?#]+)', channel)
+    if match is not None:
+        return match.group(1)
+    return channel.strip("/")
+
+
+# Watches many channels from a single asyncio event loop and records them as soon as they go live
+# Each channel is polled with conditional requests, idle channels are polled less and less often up to max_interval
+# and the intervals are jittered so the polls of hundreds of channels don't line up
+class LiveWatcher:
+    def __init__(self, channels, cookies, directoryPath, scheduler, interval=15, max_interval=60, concurrency=16):
+        self.channels = channels
+        self.cookies = cookies
+        self.directoryPath = directoryPath
+        self.scheduler = scheduler
+        self.interval = interval
+        self.max_interval = max(interval, max_interval)
+        self.concurrency = max(1, concurrency)
+        self.session = newSession()
+        # ETag and Last-Modified of the last stream status of every channel
+        self.validators = {}
+        # Live movie id (or None) of the last stream status of every channel
+        self.live = {}
+
+    # Function takes in a channel name and requests its stream status
+    # Returns the live movie id, None if it isn't live or "unchanged" if the status didn't change since the last poll
+    def checkLive(self, channel):
+        headers = {
+            'User-Agent': f'{user_agent}',
+            'Origin': 'https://twitcasting.tv'}
+        etag, last_modified = self.validators.get(channel, (None, None))
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if last_modified is not None:
+            headers['If-Modified-Since'] = last_modified
+        req = self.session.get(f"https://twitcasting.tv/streamserver.php?target={channel}&mode=client",
+                               headers=headers, cookies=self.cookies, timeout=http_timeout)
+        if req.status_code == 304:
+            # An unchanged status keeps the channel live if it was live at the last poll
+            return self.live.get(channel, "unchanged")
+        req.raise_for_status()
+        self.validators[channel] = (req.headers.get("ETag"), req.headers.get("Last-Modified"))
+        movie = req.json().get("movie") or {}
+        self.live[channel] = str(movie["id"]) if movie.get("live") else None
+        return self.live[channel]
+
+    # Records the live stream with ffmpeg until it ends
+    # Returns True if a recording was saved
+    async def record(self, channel, movie_id):
+        import asyncio
+        full_date = time.strftime("%Y%m%d")
+        # The start time keeps a reconnect to the same movie from overwriting the earlier recording
+        start_time = time.strftime("%H%M%S")
+        output_path = f'{self.directoryPath}\\{full_date} - {channel} live ({movie_id}) {start_time}.mp4'
+        if self.scheduler.audio_only:
+            output_path = os.path.splitext(output_path)[0] + ".opus"
+        part_path = output_path + ".part"
+        transcoder = self.scheduler.transcoder
+        profile_args = transcoder.profileArgs(channel) if transcoder is not None else []
+        ffmpeg_list = ffmpegCommand(f"https://twitcasting.tv/{channel}/metastream.m3u8?video=1", part_path,
+                                    self.cookies, stats=False, overwrite=True, audio_only=self.scheduler.audio_only,
+                                    profile_args=profile_args)
+        print(f"{channel} is live, recording into {output_path}")
+        record_start = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(*ffmpeg_list, stdin=subprocess.DEVNULL)
+        await process.wait()
+        recordStage("live_record", time.perf_counter() - record_start, os.path.isfile(part_path), channel=channel,
+                    bytes=os.path.getsize(part_path) if os.path.isfile(part_path) else 0)
+        # A stream that ended normally still leaves a complete recording even if ffmpeg exits with an error
+        if os.path.isfile(part_path) and os.path.getsize(part_path) > 0:
+            os.replace(part_path, output_path)
+            print(f"Finished recording {output_path}")
+            if transcoder is not None and not self.scheduler.audio_only:
+                transcoder.submit(output_path, channel)
+            return True
+        print(f"Error recording {channel}")
+        return False
+
+    # Polls a channel and records it whenever it's live
+    # Errors are only logged so one channel can't stop the watcher and every other channel
+    async def watch(self, channel, semaphore):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        interval = self.interval
+        retry_delay = 2
+        # Spread out the first polls
+        await asyncio.sleep(random.uniform(0, self.interval))
+        while not stop_event.is_set():
+            async with semaphore:
+                try:
+                    status = await loop.run_in_executor(None, self.checkLive, channel)
+                except Exception as watchException:
+                    print(f"Error checking {channel}: {watchException}")
+                    status = "error"
+            if status not in (None, "unchanged", "error"):
+                try:
+                    recorded = await self.record(channel, status)
+                except Exception as recordException:
+                    print(f"Error recording {channel}: {recordException}")
+                    recorded = False
+                # The channel may go live again right away e.g. after a dropped connection,
+                # back off a little longer after every failed recording so an ended stream isn't hammered
+                retry_delay = 2 if recorded else min(retry_delay * 2, self.max_interval)
+                interval = self.interval
+                await asyncio.sleep(retry_delay)
+                continue
+            interval = min(interval * (2 if status == "error" else 1.5), self.max_interval)
+            await asyncio.sleep(interval * random.uniform(0.8, 1.2))
 
-            # If there is more than 1 password and it's a private video
-            if len(passcode_list) >= 1 and len(title.contents) == 3:
-                # Setup selenium
-                webDriver = webDriverSetup()
-                driver = webDriver[0]
-                WebDriverWait = webDriver[1]
-                EC = webDriver[2]
-                By = webDriver[3]
+    async def run(self):
+        import asyncio
+        semaphore = asyncio.Semaphore(self.concurrency)
+        print(f"Watching {len(self.channels)} channels")
+        await asyncio.gather(*(self.watch(channel, semaphore) for channel in self.channels))
 
-                try:
-                    driver.get(link)
-                except Exception as getLinkException:
-                    sys.exit(getLinkException)
 
+# Function that watches the channels of the --watch file for live streams until interrupted
+def watchChannels(args, cookies):
+    try:
+        with open(args.watch, 'r', encoding='utf-8') as watch_file:
+            channels = list(dict.fromkeys(channelName(line) for line in watch_file if line.strip() != ""))
+    except OSError:
+        sys.exit("Can not find watch file")
+    directoryPath = getDirectory(args.output)
+    Path(directoryPath).mkdir(parents=True, exist_ok=True)
+    scheduler = getScheduler(args, cookies)
+    watcher = LiveWatcher(channels, cookies, directoryPath, scheduler, args.poll_interval, args.max_poll_interval,
+                          args.watch_concurrency)
+    import asyncio
+    asyncio.run(watcher.run())
+
+
+# Function takes in a job and the directory path
+# Returns the output file path of every m3u8 in the job
+def jobOutputs(job, directoryPath):
+    download_dir = directoryPath
+    if job["member"]:
+        download_dir = download_dir + "\\【Member Video】"
+    outputs = []
+    for i in range(len(job["m3u8"])):
+        if i == 0:
+            video_title = f"{job['date']} - {job['title']}"
+        else:
+            video_title = f"{job['date']} - {job['title']}_{i+1}"
+        # Append the unique video id to the end of the title
+        video_title = f"{video_title} ({job['id']})"
+        outputs.append(f'{download_dir}\\{video_title}.mp4')
+    return outputs
+
+
+# Function takes in a m3u8 url and checks whether its signed key has expired
+# e.g. k=/tc.vod/v/760007902.0.2-1677557604-1677586404-f21a6f25-00d91311525594a4 expires at 1677586404
+def m3u8Expired(m3u8):
+    match = re.search(r'\d+\.\d+\.\d+-(\d{10})-(\d{10})-', unquote(m3u8))
+    if match is None:
+        return False
+    return int(match.group(2)) <= time.time()
+
+
+# Function takes in a m3u8 url
+# Returns the id of the stream it belongs to or None if it can't be found
+# e.g. 760007902 for https://dl193236.twitcasting.tv/tc.vod.v2/v1/streams/760007902.0.2/hls/master.m3u8
+# or https://dl01.twitcasting.tv/tc.vod/v/674030808.0.2-1618443661-1618472461-4ec6dd13-901d44e31383a107/fmp4/index.m3u8
+def m3u8Id(m3u8):
+    match = re.search(r'/(?:streams|v)/(\d+)', unquote(m3u8))
+    if match is None:
+        return None
+    return match.group(1)
+
+
+# Function that takes in the manifest path and the jobs and appends them as json lines
+def writeManifest(manifestPath, jobs):
+    with open(manifestPath, 'a', newline='', encoding='utf-8') as manifest_file:
+        for job in jobs:
+            manifest_file.write(json.dumps(job, ensure_ascii=False) + "\n")
+
+
+# Function that takes in the manifest path and an optional shard e.g. "2/4"
+# Returns the jobs in the manifest belonging to that shard
+def readManifest(manifestPath, shard=None):
+    jobs = {}
+    shard_index, shard_count = 0, 1
+    if shard is not None:
+        try:
+            shard_index, shard_count = [int(number) for number in shard.split("/")]
+            shard_index -= 1
+            if not 0 <= shard_index < shard_count:
+                raise ValueError
+        except ValueError:
+            sys.exit("Invalid shard, it should be in the form of index/count e.g. 1/4")
+    try:
+        with open(manifestPath, 'r', newline='', encoding='utf-8') as manifest_file:
+            for line in manifest_file:
+                if line.strip() == "":
+                    continue
+                job = json.loads(line)
+                if int(job["id"]) % shard_count == shard_index:
+                    # A video extracted more than once keeps its latest record
+                    jobs[job["id"]] = job
+    except FileNotFoundError:
+        sys.exit("Can not find manifest file")
+    return list(jobs.values())
+
+
+# Function that downloads the jobs of the --manifest file without scraping the channel again
+# Returns the number of m3u8 downloaded
+def manifestDownload(args, cookies):
+    manifestPath = os.path.abspath(args.manifest)
+    jobs = readManifest(manifestPath, args.shard)
+    archivePath = getArchive(args.archive)[0] if args.archive else None
+    directoryPath = getDirectory(args.output)
+    try:
+        Path(directoryPath).mkdir(parents=True, exist_ok=True)
+        os.chdir(os.path.abspath(directoryPath))
+    except Exception as e:
+        sys.exit(str(e) + "\nError setting output directory")
+    # Keep the videos that fail to be written to the failures file at the end of the run
+    setupFailures(args, manifestPath)
+    # Skip the jobs that were already downloaded by a previous run
+    archive = Archive(archivePath) if archivePath is not None else None
+    if archive is not None:
+        jobs = [job for job in jobs if job["link"] not in archive]
+    if failure_log.replace:
+        failure_log.keep(jobs)
+    print("Jobs: " + str(len(jobs)))
+    scheduler = getScheduler(args, cookies)
+    scheduler.run(jobs, directoryPath, archive)
+    scheduler.retryFailed(directoryPath, archive)
+    # Jobs that still failed may not even have their m3u8 urls
+    failed = {job["link"] for job in scheduler.retry_queue}
+    return sum(len(job["m3u8"]) for job in jobs if job["link"] not in failed)
+
+
+# Function takes in the soup of a listing page
+# Scrapes every video on the page for its info and m3u8 urls without downloading them
+# Returns a list of jobs(one per video) along with the list of video links on the page
+def linkExtract(soup, passcode_list, archive, cookies, session, scrape_workers=1):
+    jobs = []
+    # find all video url
+    video_list = pageLinks(soup)
+    # find all tag containing video title
+    title_list = soup.find_all("span", class_="tw-movie-thumbnail-title")
+    # find all tag containing date/time
+    try:
+        date_list = soup.find_all(class_="tw-movie-thumbnail-date")
+    except:
+        # When the class "tw-movie-thumbnail-date", can't be found due to perhaps newly uploaded video or 1st video
+        date_list = soup.find_all("time")
+
+    # m3u8 urls of the private videos unlocked with a passcode
+    private_urls = {}
+    # Title and date of the videos that aren't in the archive
+    video_info = {}
+    # loops through the link and title list in parallel
+    for link, title, date in zip(video_list, title_list, date_list):
+        m3u8_url = []
+        try:
+            # If there is an archive file then skip the links already in it
+            if archive is not None and link in archive:
+                continue
+        except Exception as archiveException:
+            recordFailure({"link": link}, "archive", archiveException)
+            continue
+
+        # If there is more than 1 password and it's a private video then try unlocking it without a browser first
+        if len(passcode_list) >= 1 and len(title.contents) == 3:
+            m3u8_url, current_passcode = passcodeUnlock(link, passcode_list, cookies, session)
+            if m3u8_url is not None:
+                # Helps speeds up entering the passcode by removing used passcode
+                # It's still tried first on the channel's next videos if it's in the passcode cache
+                passcode_list[:] = [passcode for passcode in passcode_list if cleanPasscode(passcode) != current_passcode]
+                private_urls[link] = m3u8_url
+                video_info[link] = (title, date)
+                continue
+            m3u8_url = []
+            # Fall back to unlocking the video with a browser
+            unlock_start = time.perf_counter()
+            # Setup selenium
+            webDriver = getDriverPool().acquire()
+            driver = webDriver[0]
+            WebDriverWait = webDriver[1]
+            EC = webDriver[2]
+            By = webDriver[3]
+
+            try:
+                driver.get(link)
+            except Exception as getLinkException:
+                getDriverPool().release(driver)
+                sys.exit(getLinkException)
+
+            # Return the browser to the pool whatever happens while unlocking the video
+            try:
                 # Find the password field element on the page
                 password_element = WebDriverWait(driver, 15).until(
                     EC.presence_of_all_elements_located((By.CSS_SELECTOR, "input[name='password']")))
@@ -590,93 +2783,73 @@ def linkDownload(soup, directoryPath, batch, channelLink, passcode_list, archive
                         for m3u8_tag in m3u8_tag_dic['2']:
                             source_url = m3u8_tag["source"]["url"]
                             m3u8_url.append(source_url.replace("\\", ""))
-                            # prob not needed idr
-                            m3u8_link = m3u8_url
-                            # If a passcode was used/set then remove it from the passcode_list
-                            # Helps speeds up entering the passcode by removing used passcode
-                            if current_passcode is not None:
-                                passcode_list.remove(current_passcode)
-                            driver.quit()
+                        # If a passcode was used/set then remove it from the passcode_list
+                        # Helps speeds up entering the passcode by removing used passcode
+                        if current_passcode is not None and current_passcode in passcode_list:
+                            passcode_list.remove(current_passcode)
                 except Exception as noElement:
                     print("Can't find private m3u8 tag,", str(noElement), "It may be a protected stream")
-                    driver.quit()
-
-            # Send m3u8 url and ensure it's a valid m3u8 link
+            finally:
+                getDriverPool().release(driver)
+                recordStage("browser_unlock", time.perf_counter() - unlock_start, len(m3u8_url) != 0, link=link)
+            private_urls[link] = m3u8_url
+        video_info[link] = (title, date)
+
+    # Send the m3u8 urls and ensure they're valid m3u8 links, handling the videos as soon as they're resolved
+    for link, (m3u8_link, membership_status) in resolveMovies(list(video_info), cookies, session, scrape_workers):
+        title, date = video_info[link]
+        if m3u8_link is None or len(m3u8_link) == 0:
+            m3u8_link = private_urls.get(link, [])
+
+        # check to see if there are any m3u8 links
+        if len(m3u8_link) != 0:
+            # Use regex to get year, month, and day
             try:
-                m3u8_link, membership_status = m3u8_scrape(link, cookies, session)
-                if membership_status and "\\【Member Video】" not in download_dir:
-                    download_dir = download_dir + "\\【Member Video】"
-                elif not membership_status:
-                    download_dir = download_dir.replace("\\【Member Video】", "")
-            except ValueError:
+                date = date.text.strip()
+                # Find date of the video in year/month/day
+                video_date = re.search('(\d{4})/(\d{2})/(\d{2})', date)
+                day_date = video_date.group(3)
+                month_date = video_date.group(2)
+                year_date = video_date.group(1)
+            except:
+                recordFailure({"link": link, "title": checkFileName(title.text.strip()), "member": membership_status,
+                               "m3u8": m3u8_link}, "date", "Can't find the date of the video")
                 continue
+            # Get unique video id
+            vid_id = str(re.search("(\d+)$", link).group())
+            video_title = checkFileName(title.text.strip())
+            full_date = year_date + month_date + day_date
+            print(f"Title: {full_date} - {video_title} ({vid_id})")
+            # All the m3u8 of a video are a single job so it's only archived once all of them are downloaded
+            jobs.append({"id": vid_id, "link": link, "title": video_title, "date": full_date,
+                         "member": membership_status, "m3u8": m3u8_link})
+        else:
+            print("Error can't find m3u8 links")
+    return jobs, video_list
 
-            if m3u8_link is None or len(m3u8_link) == 0:
-                m3u8_link = m3u8_url
 
-            # check to see if there are any m3u8 links
-            if len(m3u8_link) != 0:
-                # Use regex to get year, month, and day
-                try:
-                    date = date.text.strip()
-                    # Find date of the video in year/month/day
-                    video_date = re.search('(\d{4})/(\d{2})/(\d{2})', date)
-                    day_date = video_date.group(3)
-                    month_date = video_date.group(2)
-                    year_date = video_date.group(1)
-                except:
-                    exit("Error getting dates")
-                # Loop through and download all the m3u8
-                for i, m3u8 in enumerate(m3u8_link):
-                    # Only write title if src isn't in the tag
-                    # Meaning it's not a private video title
-                    if not title.has_attr('src'):
-                        full_date = year_date + month_date + day_date
-                        video_title = checkFileName(title.text.strip())
-                        if i == 0:
-                            video_title = f"{full_date} - {video_title}"
-                        else:
-                            video_title = f"{full_date} - {video_title}_{i+1}"
-
-                    # Get unique video id and append to the end of the title
-                    vid_id = str(re.search("(\d+)$", link).group())
-                    video_title = f"{video_title} ({vid_id})"
-                    if os.path.isfile(f'{download_dir}\\{video_title}.mp4'):
-                        video_title = video_title + str(i)
-                    print("Title: " + str(video_title))
-                    linksExtracted = linksExtracted + 1
-                    # Use -re, -user_agent, and -headers to set x1 read speed and avoid 502 error
-                    # Use -n to avoid overwriting files and then avoid re-encoding by using copy
-                    # -c copy -bsf:a aac_adtstoasc
-                    # ffmpeg_list = ['ffmpeg', '-re', '-user_agent',
-                    #                "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/89.0.4389.114 Safari/537.36",
-                    #                '-headers', "Origin: https://twitcasting.tv"]
-
-                    ffmpeg_list = ['ffmpeg', '-v', 'quiet', '-stats', '-user_agent', user_agent,
-                                   '-headers', "Origin: https://twitcasting.tv"]
-                    if cookies != {}:
-                        ffmpeg_list += ['-headers', f"Cookie: 'tc_id'={cookies['tc_id']}; tc_ss={cookies['tc_ss']}"]
-                    # Note split at & since cmd doesn't like it: e.g. https://dl193236.twitcasting.tv/tc.vod.v2/v1/streams/760007902.0.2/hls/master.m3u8?k=%2Ftc.vod%2Fv%2F760007902.0.2-1677557604-1677586404-f21a6f25-00d91311525594a4&spm=1
-                    ffmpeg_list += ['-n', '-i', m3u8.split("&")[0], '-c', 'copy', '-movflags', '+faststart', '-f', 'mp4', '-bsf:a', 'aac_adtstoasc']
-                    ffmpeg_list += [f'{download_dir}\\{video_title}.mp4']
-                    # Add check for if -a is not specified but downloaded channel video already exist
-                    # So check if {title} + .mp4 matches filename in that cwd
-                    try:
-                        subprocess.run(ffmpeg_list, check=True)
-                    except subprocess.CalledProcessError:
-                        sys.exit("Error executing ffmpeg")
-                    print(f"\nExecuted and downloaded {i+1}/{len(m3u8_link)}")
-                # Reset m3u8 link and url
-                m3u8_link = []
-                m3u8_url = []
-                if archivePath is not None:
-                    with open(archivePath, txt_format, newline='') as txt_file:
-                        archiveExist = True
-                        txt_file.write(link + "\n")
-                        # Set appended to be true so on error this appended link can be tested and removed
-                        print(f"Appended {link} to archive file\n")
-            else:
-                print("Error can't find m3u8 links")
+# Function takes four arguments: soup, directory path, boolean value batch, and the channel link
+# Scrapes for video info
+# And then calls ffmpeg to download the stream
+# Returns the number of video url extracted for that page
+def linkDownload(soup, directoryPath, batch, channelLink, passcode_list, archive, cookies, scheduler=None,
+                 scrape_workers=1):
+    import requests
+    video_list = []
+    m3u8_link = []
+    linksExtracted = 0
+    curr_dir = directoryPath
+    m3u8_url = []
+    session = newSession()
+    if scheduler is None:
+        scheduler = DownloadScheduler(1, 1, cookies)
+    # Batch download
+    if batch:
+        jobs, video_list = linkExtract(soup, passcode_list, archive, cookies, session, scrape_workers)
+        for job in jobs:
+            linksExtracted = linksExtracted + len(job["m3u8"])
+        # Download all the jobs found on this page and append them to the archive as they finish
+        scheduler.run(jobs, directoryPath, archive)
 
     # Single link download
     else:
@@ -709,41 +2882,51 @@ def linkDownload(soup, directoryPath, batch, channelLink, passcode_list, archive
             except:
                 title = "temp"
 
-            # Setup selenium
-            webDriver = webDriverSetup()
-            driver = webDriver[0]
-            WebDriverWait = webDriver[1]
-            EC = webDriver[2]
-            By = webDriver[3]
+            # Try unlocking the video without a browser first
+            m3u8_url = passcodeUnlock(channelLink, passcode_list, cookies, session)[0]
+            if m3u8_url is not None:
+                m3u8_link = m3u8_url[0]
+            # Fall back to unlocking the video with a browser
+            else:
+                unlock_start = time.perf_counter()
+                # Setup selenium
+                webDriver = getDriverPool().acquire()
+                driver = webDriver[0]
+                WebDriverWait = webDriver[1]
+                EC = webDriver[2]
+                By = webDriver[3]
 
-            try:
-                driver.get(channelLink)
-            except Exception as getLinkException:
-                sys.exit(getLinkException)
+                try:
+                    driver.get(channelLink)
+                except Exception as getLinkException:
+                    getDriverPool().release(driver)
+                    sys.exit(getLinkException)
 
-            # Find the password field element on the page
-            password_element = WebDriverWait(driver, 15).until(
-                EC.presence_of_all_elements_located((By.CSS_SELECTOR, "input[name='password']")))
-            button_element = WebDriverWait(driver, 15).until(
-                EC.presence_of_all_elements_located((By.CLASS_NAME, "tw-button-secondary.tw-button-small")))
-            # Enter and submit the passcode
-            password_element[0].send_keys(passcode_list[0])
-            button_element[0].click()
+                # Find the password field element on the page
+                password_element = WebDriverWait(driver, 15).until(
+                    EC.presence_of_all_elements_located((By.CSS_SELECTOR, "input[name='password']")))
+                button_element = WebDriverWait(driver, 15).until(
+                    EC.presence_of_all_elements_located((By.CLASS_NAME, "tw-button-secondary.tw-button-small")))
+                # Enter and submit the passcode
+                password_element[0].send_keys(passcode_list[0])
+                button_element[0].click()
 
-            # Try to find the video element
-            try:
-                m3u8_tag = WebDriverWait(driver, 15).until(
-                    EC.presence_of_all_elements_located((By.CSS_SELECTOR, "div[data-movie-playlist]")))
-                # If video element is found then get the m3u8 url
-                if len(m3u8_tag) > 0:
-                    m3u8_tag_dic = json.loads(m3u8_tag[0].get_attribute("data-movie-playlist"))
-                    source_url = m3u8_tag_dic.get("2")[0].get("source").get("url")
-                    m3u8_url = source_url.replace("\\", "")
-                    m3u8_link = m3u8_url
-                    driver.quit()
-            except Exception as noElement:
-                print(str(noElement) + "\nCan't find private m3u8 tag")
-                driver.quit()
+                # Try to find the video element
+                try:
+                    m3u8_tag = WebDriverWait(driver, 15).until(
+                        EC.presence_of_all_elements_located((By.CSS_SELECTOR, "div[data-movie-playlist]")))
+                    # If video element is found then get the m3u8 url
+                    if len(m3u8_tag) > 0:
+                        m3u8_tag_dic = json.loads(m3u8_tag[0].get_attribute("data-movie-playlist"))
+                        source_url = m3u8_tag_dic.get("2")[0].get("source").get("url")
+                        m3u8_url = source_url.replace("\\", "")
+                        m3u8_link = m3u8_url
+                except Exception as noElement:
+                    print(str(noElement) + "\nCan't find private m3u8 tag")
+                finally:
+                    getDriverPool().release(driver)
+                    recordStage("browser_unlock", time.perf_counter() - unlock_start, len(m3u8_link) != 0,
+                                link=channelLink)
 
             #copy from else statement below
             # check to see if there are any m3u8 links
@@ -762,21 +2945,10 @@ def linkDownload(soup, directoryPath, batch, channelLink, passcode_list, archive
                 print("Title: ", title)
                 linksExtracted = linksExtracted + 1
                 download_dir = curr_dir
-                # Use -re, -user_agent, and -headers to set x1 read speed and avoid 502 error
-                # Use -n to avoid overwriting files and then avoid re-encoding by using copy
-                # ffmpeg_list = ['ffmpeg', '-re', '-user_agent',
-                #                "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/89.0.4389.114 Safari/537.36",
-                #                '-headers', "Origin: https://twitcasting.tv"]
-
-                ffmpeg_list = ['ffmpeg', '-v', 'quiet', '-stats', '-user_agent', user_agent,
-                               '-headers', "Origin: https://twitcasting.tv"]
-                if cookies != {}:
-                    ffmpeg_list += ['-headers', f"Cookie: 'tc_id'={cookies['tc_id']}; tc_ss={cookies['tc_ss']}"]
-                ffmpeg_list += ['-n', '-i', m3u8_link, '-c', 'copy', '-movflags', '+faststart', '-f', 'mp4', '-bsf:a', 'aac_adtstoasc']
-                ffmpeg_list += [f'{download_dir}\\{video_title}.mp4']
                 try:
-                    subprocess.run(ffmpeg_list, check=True)
-                except subprocess.CalledProcessError:
+                    scheduler.download(m3u8_link, f'{download_dir}\\{video_title}.mp4',
+                                       movieInfo(channelLink)[0])
+                except (subprocess.CalledProcessError, requests.RequestException):
                     sys.exit("Error executing ffmpeg")
                 print("\nExecuted")
             else:
@@ -807,21 +2979,10 @@ def linkDownload(soup, directoryPath, batch, channelLink, passcode_list, archive
                     print("Title: ", video_title)
                     linksExtracted = linksExtracted + 1
                     download_dir = curr_dir
-                    # Use -re, -user_agent, and -headers to set x1 read speed and avoid 502 error
-                    # Use -n to avoid overwriting files and then avoid re-encoding by using copy
-                    # ffmpeg_list = ['ffmpeg', '-re', '-user_agent',
-                    #                "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/89.0.4389.114 Safari/537.36",
-                    #                '-headers', "Origin: https://twitcasting.tv"]
-
-                    ffmpeg_list = ['ffmpeg', '-v', 'quiet', '-stats', '-user_agent', user_agent,
-                                   '-headers', "Origin: https://twitcasting.tv"]
-                    if cookies != {}:
-                        ffmpeg_list += ['-headers', f"Cookie: 'tc_id'={cookies['tc_id']}; tc_ss={cookies['tc_ss']}"]
-                    ffmpeg_list += ['-n', '-i', m3u8, '-c', 'copy', '-movflags', '+faststart', '-f', 'mp4', '-bsf:a', 'aac_adtstoasc']
-                    ffmpeg_list += [f'{download_dir}\\{video_title}.mp4']
                     try:
-                        subprocess.run(ffmpeg_list, check=True)
-                    except subprocess.CalledProcessError:
+                        scheduler.download(m3u8, f'{download_dir}\\{video_title}.mp4',
+                                           movieInfo(channelLink)[0])
+                    except (subprocess.CalledProcessError, requests.RequestException):
                         sys.exit("Error executing ffmpeg")
                     print(f"\nExecuted and downloaded {i+1}/{len(m3u8_link)}\n")
             else:
@@ -829,21 +2990,290 @@ def linkDownload(soup, directoryPath, batch, channelLink, passcode_list, archive
     return linksExtracted, video_list
 
 
+# Function takes in the arguments and sets up the browsers used for passcode protected videos(only started once
+# needed) along with the passcodes tried on them
+def setupUnlocking(args):
+    global driver_pool, passcode_cache, passcode_workers
+    driver_pool = DriverPool(args.drivers)
+    passcode_cache = PasscodeCache(os.path.abspath(args.passcode_cache))
+    passcode_workers = args.passcode_workers
+
+
+# Function that downloads every page of a channel for the daemon
+# Returns the number of m3u8 downloaded
+def channelDownload(channelLink, channelFilter, directoryPath, passcode_list, archive, cookies, session, scheduler, args):
+    soup = soupSetup(channelLink, cookies, session)
+    totalPages = urlCount(soup, channelFilter)[0]
+    linksExtracted = 0
+    for currentPage, soup in crawlPages(soup, channelLink, int(totalPages), cookies, session, args.crawl_workers):
+        print("\nPage: " + str(currentPage + 1))
+        linksExtracted += linkDownload(soup, directoryPath, True, channelLink, passcode_list, archive, cookies,
+                                       scheduler, args.scrape_workers)[0]
+    return linksExtracted
+
+
+# Runs the channel, movie and m3u8 jobs submitted through a local http api
+# The session, archive, browsers, scheduler and transcoder stay warm and are shared by all the jobs
+#   POST /jobs with {"url": ..., "type": "channel" | "movie" | "m3u8"(optional), "passcodes": [...](optional)}
+#   GET /jobs and GET /jobs/<id> return the status of the jobs
+class JobServer:
+    def __init__(self, args, cookies, directoryPath):
+        self.args = args
+        self.cookies = cookies
+        self.directoryPath = directoryPath
+        self.session = newSession()
+        self.archive = Archive(getArchive(args.archive)[0]) if args.archive else None
+        self.scheduler = getScheduler(args, cookies)
+        self.executor = ThreadPoolExecutor(max_workers=max(1, args.daemon_workers))
+        self.jobs = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+    # Function takes in the body of a job request
+    # Returns the queued job
+    def submit(self, request):
+        url = request.get("url")
+        if not isinstance(url, str) or url.strip() == "":
+            raise ValueError("A job needs a url")
+        job_type = request.get("type")
+        if job_type is None:
+            job_type = "m3u8" if ".m3u8" in url else "movie" if re.search(r'/movie/\d+', url) else "channel"
+        if job_type not in ("channel", "movie", "m3u8"):
+            raise ValueError("The job type must be channel, movie or m3u8")
+        passcodes = request.get("passcodes", [])
+        if not isinstance(passcodes, list) or not all(isinstance(passcode, str) for passcode in passcodes):
+            raise ValueError("The passcodes must be a list of strings")
+        with self.lock:
+            job = {"id": self.next_id, "url": url.strip(), "type": job_type, "status": "queued",
+                   "passcodes": passcodes, "links": 0, "failed": 0, "retried": 0,
+                   "error": None, "submitted": time.time(), "finished": None}
+            self.jobs[job["id"]] = job
+            self.next_id += 1
+        self.executor.submit(self.runJob, job)
+        return job
+
+    def runJob(self, job):
+        job["status"] = "running"
+        try:
+            job["links"] = self.process(job)
+            job["status"] = "done"
+        # The download functions exit on errors which only fails the job here
+        except SystemExit as jobExit:
+            job["status"], job["error"] = "failed", str(jobExit.code)
+        except Exception as jobException:
+            job["status"], job["error"] = "failed", str(jobException)
+        job["finished"] = time.time()
+
+    # Returns the number of m3u8 downloaded for the job
+    def process(self, job):
+        url = job["url"]
+        if job["type"] == "m3u8":
+            video_id = m3u8Id(url)
+            if video_id is None:
+                raise ValueError(f"Can't find the stream id of {url}")
+            self.scheduler.download(url, f'{self.directoryPath}\\{video_id}.mp4')
+            return 1
+        # The videos that fail are retried within their own job rather than by whichever job retries next
+        scheduler = self.scheduler.jobScheduler()
+        try:
+            return self.processLinks(job, url, scheduler)
+        finally:
+            job["failed"], job["retried"] = len(scheduler.retry_queue), scheduler.retried
+
+    # Returns the number of m3u8 downloaded for a movie or channel job
+    def processLinks(self, job, url, scheduler):
+        if "https://" not in url and "http://" not in url:
+            url = "https://" + url
+        if job["type"] == "movie":
+            soup = soupSetup(url, self.cookies, self.session)
+            return linkDownload(soup, self.directoryPath, False, url, list(job["passcodes"]), self.archive,
+                                self.cookies, scheduler, self.args.scrape_workers)[0]
+        if not re.search(r'/(show|showclips|archive)', url):
+            url = url.rstrip("/") + "/show/"
+        channelLink, channelFilter = linkCleanUp(url, self.cookies)
+        links = channelDownload(channelLink, channelFilter, self.directoryPath, list(job["passcodes"]),
+                                self.archive, self.cookies, self.session, scheduler, self.args)
+        scheduler.retryFailed(self.directoryPath, self.archive)
+        return links
+
+    # Returns a copy of a job or of all the jobs that can be sent back as json
+    def status(self, job_id=None):
+        with self.lock:
+            if job_id is None:
+                return [dict(job) for job in self.jobs.values()]
+            return dict(self.jobs[job_id]) if job_id in self.jobs else None
+
+
+# Handles the requests of the job api, mixed into http.server's BaseHTTPRequestHandler by serveJobs
+class JobRequestHandler:
+    def sendJson(self, code, body):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        path = self.path.rstrip("/")
+        if path == "/metrics":
+            data = telemetry.prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        if path == "/downloads":
+            self.sendJson(200, self.server.job_server.scheduler.progressSnapshot())
+            return
+        if path == "/jobs":
+            self.sendJson(200, self.server.job_server.status())
+            return
+        match = re.fullmatch(r'/jobs/(\d+)', path)
+        job = self.server.job_server.status(int(match.group(1))) if match is not None else None
+        if job is None:
+            self.sendJson(404, {"error": "Job not found"})
+        else:
+            self.sendJson(200, job)
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            self.sendJson(404, {"error": "Not found"})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(request, dict):
+                raise ValueError("The job must be a json object")
+            self.sendJson(202, self.server.job_server.submit(request))
+        except ValueError as requestException:
+            self.sendJson(400, {"error": str(requestException)})
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Function that runs the daemon serving the job api on --serve until interrupted
+def serveJobs(args, cookies):
+    host, _, port = args.serve.rpartition(":")
+    try:
+        port = int(port)
+    except ValueError:
+        sys.exit("Invalid --serve address, it should be in the form of [host:]port e.g. 127.0.0.1:8787")
+    directoryPath = getDirectory(args.output)
+    try:
+        Path(directoryPath).mkdir(parents=True, exist_ok=True)
+        os.chdir(os.path.abspath(directoryPath))
+    except Exception as e:
+        sys.exit(str(e) + "\nError setting output directory")
+    setupFailures(args)
+    setupUnlocking(args)
+    # The daemon always keeps the stage totals for GET /metrics
+    if telemetry is None:
+        setupTelemetry(args, always=True)
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    handler = type("JobRequestHandler", (JobRequestHandler, BaseHTTPRequestHandler), {})
+    server = ThreadingHTTPServer((host or "127.0.0.1", port), handler)
+    server.job_server = JobServer(args, cookies, directoryPath)
+    print(f"Serving the job api on http://{host or '127.0.0.1'}:{port}/jobs")
+    server.serve_forever()
+
+
+# Function takes in the arguments and sets up the transcoder converting the downloads into .opus
+# Returns the transcoder
+def getTranscoder(args):
+    global transcoder
+    if transcoder is None:
+        channel_profiles = {}
+        if args.channel_profiles:
+            try:
+                with open(args.channel_profiles, 'r', encoding='utf-8') as profiles_file:
+                    channel_profiles = json.load(profiles_file)
+            except (OSError, ValueError) as profilesException:
+                sys.exit(str(profilesException) + "\nError reading the channel profiles file")
+        for profile in [args.profile] + list(channel_profiles.values()):
+            if profile not in transcode_profiles:
+                sys.exit(f"Unknown transcode profile {profile}, the profiles are: " + ", ".join(transcode_profiles))
+        transcoder = Transcoder(args.transcode_workers, args.profile, channel_profiles, args.transcode_threads)
+    return transcoder
+
+
+# Function takes in the arguments and the cookies
+# Returns the download scheduler set up with them
+def getScheduler(args, cookies):
+    return DownloadScheduler(args.workers, args.host_limit, cookies, args.native_hls, args.segment_workers,
+                             getTranscoder(args), args.audio_only, args.stall_timeout, args.stall_retries,
+                             args.progress_interval, args.job_retries, args.retry_delay)
+
+
+# Keyboard interrupt handler, the downloads keep their progress to be resumed by the next run
+def interrupt(signum, frame):
+    stop_event.set()
+    sys.exit("\nKeyboard Interrupt")
+
+
 # Function that scrapes/download the entire channel or single link
 # while printing out various information onto the console
 def main():
+    global html_parser, page_limiter
     # Check for keyboard interrupt
-    signal.signal(signal.SIGINT, lambda x, y: sys.exit("\nKeyboard Interrupt"))
+    signal.signal(signal.SIGINT, interrupt)
     # Links extracted
     linksExtracted = 0
     # Get commandline arguments
     args = arguments()
+    # Time how long the script takes to start
+    if args.benchmark_startup is not None:
+        benchmarkStartup(args.benchmark_startup)
+        sys.exit()
+    # Set up the timings of the stages of the run
+    setupTelemetry(args)
+    # Set up the connection pool shared by every request
+    configureHttp(args.pool_size, args.http_retries, args.http_backoff, args.connect_timeout, args.read_timeout)
+    if args.http_stats:
+        atexit.register(printHttpStats)
+    if args.check_http:
+        checkHttp()
+        sys.exit()
+    if args.parser:
+        html_parser = args.parser
+    # Set up the rate limit of the page requests
+    page_limiter = RateLimiter(args.rate)
+    # Set up the page cache
+    if not args.no_cache:
+        setupCache(args.cache_size)
     # Get cookies for membership videos
     if args.cookies:
         cookies = getCookies("".join(args.cookies))
     else:
         cookies = {}
 
+    # Compare the html parsers on saved pages
+    if args.benchmark_parsers:
+        benchmarkParsers(args.benchmark_parsers)
+        sys.exit()
+
+    # Compare the transcode profiles on a sample file
+    if args.benchmark_profiles:
+        benchmarkProfiles(args.benchmark_profiles, args.transcode_threads)
+        sys.exit()
+
+    # Run as a daemon taking jobs from the api rather than downloading a link
+    if args.serve:
+        serveJobs(args, cookies)
+        sys.exit()
+
+    # Watch channels for live streams rather than downloading a link
+    if args.watch:
+        watchChannels(args, cookies)
+        sys.exit()
+
+    # Download the jobs of a manifest rather than a link
+    if args.manifest:
+        linksExtracted += manifestDownload(args, cookies)
+        sys.exit("\nTotal Links Extracted: " + str(linksExtracted) + "\nExiting")
+
     # Get the clean twitcast channel link
     try:
         linkCleanedUp = linkCleanUp(args.link, cookies)
@@ -873,8 +3303,17 @@ def main():
     else:
         archive_info = [None, False]
 
+    # Set up the browsers and the passcode cache used for passcode protected videos
+    setupUnlocking(args)
+
+    # Set up the download scheduler
+    scheduler = getScheduler(args, cookies)
+
+    # The manifest is resolved before changing into the output directory
+    manifestPath = os.path.abspath(args.extract) if args.extract else None
+
     # Set up beautifulsoup
-    session = requests.Session()
+    session = newSession()
     soup = soupSetup(channelLink, cookies, session)
     # Get the filename
     fileName = getFileName(soup, channelLink, args.name)
@@ -897,6 +3336,17 @@ def main():
     # Check if the file exist and if it does delete it
     checkFile(fileName)
 
+    # Load the archive once, it's opened relative to the output directory
+    try:
+        archive = Archive(archive_info[0]) if archive_info[0] is not None else None
+    except Exception as archiveException:
+        sys.exit(str(archiveException) + "\n Error occurred reading the archive file")
+    if args.sync is not None and archive is None:
+        sys.exit("--sync requires an --archive file to know which videos were already downloaded")
+    # Keep the videos that fail to be written to the failures file at the end of the run
+    if manifestPath is None and not args.scrape:
+        setupFailures(args)
+
     # Count the total pages and links to be scraped
     # If it's a batch download/scrape set to true
     batch = channelFilter is not None
@@ -908,32 +3358,66 @@ def main():
 
         if args.scrape:
             print("Filename: " + fileName)
-        for currentPage in range(int(totalPages)):
+        # Number of videos in a row that are already in the archive
+        archivedRun = 0
+        # Pages are fetched one at a time when syncing so that the sync stops as soon as possible
+        crawlWorkers = 1 if args.sync is not None else args.crawl_workers
+        for currentPage, soup in crawlPages(soup, channelLink, int(totalPages), cookies, session, crawlWorkers):
             if (currentPage == int(totalPages)):
                 print("\nPage: " + str(currentPage - 1))
             else:
                 print("\nPage: " + str(currentPage + 1))
-            if (currentPage != 0):
-                updatedLink = updateLink(channelLink, currentPage)
-                soup = soupSetup(updatedLink, cookies, session)
+            # Check whether the sync reaches the videos downloaded by a previous run on this page
+            syncDone = False
+            if args.sync is not None:
+                for link in pageLinks(soup):
+                    archivedRun = archivedRun + 1 if link in archive else 0
+                    if archivedRun >= args.sync:
+                        syncDone = True
+                        break
+            # If --extract is specified then only write the jobs into the manifest
+            if manifestPath is not None:
+                jobs = linkExtract(soup, passcode_list, archive, cookies, session, args.scrape_workers)[0]
+                writeManifest(manifestPath, jobs)
+                linksExtracted += sum(len(job["m3u8"]) for job in jobs)
+                print("\nTotal Links Extracted: " + str(linksExtracted) + "/" + totalLinks)
             # If --scrape is not specified then download video else just scrape
-            if not args.scrape:
-                linksExtracted += linkDownload(soup, directoryPath, batch, channelLink, passcode_list, archive_info, cookies)[0]
+            elif not args.scrape:
+                linksExtracted += linkDownload(soup, directoryPath, batch, channelLink, passcode_list, archive, cookies,
+                                               scheduler, args.scrape_workers)[0]
                 if batch:
                     print("\nTotal Links Extracted: " + str(linksExtracted) + "/" + totalLinks + "\nExiting")
                 else:
                     sys.exit("\nTotal Links Extracted: " + str(linksExtracted) + "/" + "1" + "\nExiting")
 
             else:
-                linksExtracted += linkScrape(fileName, soup, batch, passcode_list, cookies)[0]
+                linksExtracted += linkScrape(fileName, soup, batch, passcode_list, cookies, args.scrape_workers)[0]
                 if batch:
                     print("\nTotal Links Extracted: " + str(linksExtracted) + "/" + totalLinks + "\nExiting")
                 else:
                     print("\nTotal Links Extracted: " + str(linksExtracted) + "/" + "1" + "\nExiting")
+            if syncDone:
+                print("\nReached the videos already in the archive, sync finished")
+                break
+        # Retry the videos that failed now that the rest of the channel is done
+        scheduler.retryFailed(directoryPath, archive)
     # Initiate single download or scrape
     else:
-        if not args.scrape:
-            linksExtracted += linkDownload(soup, directoryPath, batch, channelLink, passcode_list, archive_info, cookies)[0]
+        # If --extract is specified then only write the video's job into the manifest
+        if manifestPath is not None:
+            if archive is not None and channelLink in archive:
+                print(f"{channelLink} is already in the archive")
+            else:
+                try:
+                    job = movieJob(channelLink, cookies, session)
+                except ValueError as extractException:
+                    sys.exit(str(extractException) + "\nError extracting " + channelLink)
+                writeManifest(manifestPath, [job])
+                linksExtracted += len(job["m3u8"])
+            print("\nTotal Links Extracted: " + str(linksExtracted) + "/" + "1" + "\nExiting")
+        elif not args.scrape:
+            linksExtracted += linkDownload(soup, directoryPath, batch, channelLink, passcode_list, archive, cookies,
+                                           scheduler)[0]
             print("\nTotal Links Extracted: " + str(linksExtracted) + "/" + "1" + "\nExiting")
         else:
             linksExtracted += linkScrape(fileName, channelLink, batch, passcode_list, cookies)[0]
@@ -943,17 +3427,17 @@ def main():
 if __name__ == '__main__':
     try:
         main()
-        for filename in os.listdir(os.getcwd()):
-            if filename.endswith(".mp4"):
-                originalFilename = filename.split(".mp4")[0]
-                os.system(
-                    f'ffmpeg -i "{filename}" -c:a libopus "{originalFilename}.opus"'
-                )
-                print(f"{filename} has been sent to the trash can")
-                send2trash.send2trash(filename)
-            else:
-                continue
     except Exception as e:
         exc_type, exc_obj, exc_tb = sys.exc_info()
         # sys.exit(str(e) + "\nUnexpected Error")
         traceback.print_exc()
+    finally:
+        # Let the transcodes of the files downloaded by this run finish
+        if transcoder is not None:
+            transcoder.wait()
+        # Write out the videos that still failed
+        if failure_log is not None:
+            failure_log.close()
+        # Write out and print the timings of the run
+        if telemetry is not None:
+            telemetry.close()